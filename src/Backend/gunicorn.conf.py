@@ -0,0 +1,27 @@
+# Production serving: gunicorn -c gunicorn.conf.py run:app
+# Socket.IO needs a cooperative worker (eventlet or gevent) so one process can hold
+# thousands of idle websockets. Run one worker per process/container and scale out
+# with more nodes behind the load balancer.
+import os
+
+worker_class = {
+    'eventlet': 'eventlet',
+    'gevent': 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+}[os.environ.setdefault('ASYNC_MODE', 'eventlet')]
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+# run.py sizes its Mongo pool from this (a quarter of it unless
+# MONGO_MAX_POOL_SIZE is set), so raise both together
+worker_connections = int(os.environ.setdefault('WORKER_CONNECTIONS', '2000'))
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+timeout = int(os.environ.get('WORKER_TIMEOUT', 60))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+
+
+def post_worker_init(worker):
+    from run import startup
+    startup()
+
+
+def worker_exit(server, worker):
+    from run import shutdown
+    shutdown()
@@ -1,23 +1,117 @@
-from flask import Flask, request, jsonify
+import os
+
+# Cooperative serving backends have to patch the stdlib before anything else imports it
+ASYNC_MODE = os.environ.get('ASYNC_MODE') or None
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, request, jsonify, send_from_directory
+from flask.json.provider import DefaultJSONProvider
 from flask_socketio import SocketIO, join_room
 from flask_cors import CORS
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne, ReturnDocument
+from pymongo.errors import OperationFailure, PyMongoError, DuplicateKeyError, BulkWriteError
 from bson.objectid import ObjectId
+from bson.errors import InvalidId
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import jwt
-import os
 from functools import wraps
 import uuid
+import click
+import time
+import threading
+import json
+import hashlib
+import calendar
+import base64
+import atexit
+import bisect
+import importlib
+import platform
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+class MongoJSONProvider(DefaultJSONProvider):
+    # Encodes ObjectId and datetime directly so routes can return documents as read
+    # from Mongo. Naive datetimes are UTC throughout this app.
+    @staticmethod
+    def default(o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, datetime):
+            return (o if o.tzinfo else o.replace(tzinfo=timezone.utc)).isoformat()
+        return DefaultJSONProvider.default(o)
+    
+    def dumps(self, obj, **kwargs):
+        if orjson is not None:
+            return orjson.dumps(obj, default=self.default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS).decode()
+        return super().dumps(obj, **kwargs)
+    
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
 
 app = Flask(__name__)
-CORS(app, supports_credentials=True)
+CORS(app, supports_credentials=True, expose_headers=['X-Next-Cursor'])
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'your-secret-key-here')
-socketio = SocketIO(app, cors_allowed_origins="*")
+app.json = MongoJSONProvider(app)
+# With SOCKETIO_MESSAGE_QUEUE set (redis://... for multi-node deployments, or
+# memory:// as an in-process stand-in), emits are published through the queue so
+# every node delivers them to the members of the room it holds locally. Polling
+# transports need sticky sessions; SOCKETIO_WEBSOCKET_ONLY avoids that.
+socketio = SocketIO(
+    app,
+    cors_allowed_origins="*",
+    json=app.json,
+    async_mode=ASYNC_MODE,
+    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE') or None,
+    channel=os.environ.get('SOCKETIO_CHANNEL', 'lingzee-socketio'),
+    transports=['websocket'] if os.environ.get('SOCKETIO_WEBSOCKET_ONLY', 'false') == 'true' else ['polling', 'websocket'],
+    ping_interval=int(os.environ.get('SOCKETIO_PING_INTERVAL', 25)),
+    ping_timeout=int(os.environ.get('SOCKETIO_PING_TIMEOUT', 20)),
+    max_http_buffer_size=int(os.environ.get('SOCKETIO_MAX_BUFFER', 1000000))
+)
 
 # MongoDB setup
-# MongoDB setup
-client = MongoClient(os.environ.get('MONGODB_URI', 'mongodb://localhost:27017'))
+# The pool bounds how many greenlets/threads can talk to Mongo at once; the rest
+# wait up to MONGO_WAIT_QUEUE_TIMEOUT_MS instead of piling up connections. Under
+# a cooperative worker it defaults to a quarter of WORKER_CONNECTIONS (set by
+# gunicorn.conf.py): most greenlets are idle websockets, but a busy worker must
+# not queue every request behind a pool sized for a threaded server.
+if ASYNC_MODE:
+    DEFAULT_MONGO_POOL_SIZE = max(100, int(os.environ.get('WORKER_CONNECTIONS', 2000)) // 4)
+else:
+    DEFAULT_MONGO_POOL_SIZE = 100
+client = MongoClient(
+    os.environ.get('MONGODB_URI', 'mongodb://localhost:27017'),
+    maxPoolSize=int(os.environ.get('MONGO_MAX_POOL_SIZE', DEFAULT_MONGO_POOL_SIZE)),
+    minPoolSize=int(os.environ.get('MONGO_MIN_POOL_SIZE', 0)),
+    waitQueueTimeoutMS=int(os.environ.get('MONGO_WAIT_QUEUE_TIMEOUT_MS', 5000)),
+    serverSelectionTimeoutMS=int(os.environ.get('MONGO_SERVER_SELECTION_TIMEOUT_MS', 5000))
+)
 db = client['learning_assistant']
 
 # Collections
@@ -29,6 +123,1307 @@ progress_collection = db.progress
 bookmarks_collection = db.bookmarks
 sessions_collection = db.sessions
 messages_collection = db.messages
+points_ledger_collection = db.points_ledger
+metrics_collection = db.metrics
+jobs_collection = db.jobs
+message_archives_collection = db.message_archives
+
+# Indexes
+INDEXES = {
+    users_collection: [
+        ([('username', ASCENDING)], {'unique': True}),
+        ([('email', ASCENDING)], {'unique': True})
+    ],
+    courses_collection: [
+        ([('is_published', ASCENDING), ('is_featured', ASCENDING)], {})
+    ],
+    lessons_collection: [
+        ([('course_id', ASCENDING), ('is_published', ASCENDING), ('order', ASCENDING)], {})
+    ],
+    enrollments_collection: [
+        ([('user_id', ASCENDING), ('course_id', ASCENDING)], {'unique': True}),
+        ([('course_id', ASCENDING)], {})
+    ],
+    progress_collection: [
+        ([('user_id', ASCENDING), ('course_id', ASCENDING), ('lesson_id', ASCENDING)], {'unique': True}),
+        ([('course_id', ASCENDING)], {})
+    ],
+    bookmarks_collection: [
+        ([('user_id', ASCENDING), ('lesson_id', ASCENDING)], {'unique': True}),
+        ([('lesson_id', ASCENDING)], {})
+    ],
+    sessions_collection: [
+        ([('session_id', ASCENDING)], {'unique': True}),
+        ([('user_id', ASCENDING), ('course_id', ASCENDING), ('last_active_at', DESCENDING)], {}),
+        ([('last_active_at', ASCENDING)], {})
+    ],
+    messages_collection: [
+        ([('session_id', ASCENDING), ('timestamp', ASCENDING), ('_id', ASCENDING)], {}),
+        ([('timestamp', ASCENDING)], {})
+    ],
+    message_archives_collection: [
+        ([('session_id', ASCENDING), ('to', DESCENDING)], {})
+    ],
+    points_ledger_collection: [
+        ([('user_id', ASCENDING), ('lesson_id', ASCENDING)], {'unique': True}),
+        ([('status', ASCENDING), ('awarded_at', ASCENDING)], {'partialFilterExpression': {'status': 'pending'}}),
+        ([('course_id', ASCENDING), ('user_id', ASCENDING)], {})
+    ],
+    jobs_collection: [
+        ([('status', ASCENDING)], {})
+    ]
+}
+
+def index_name(keys):
+    return '_'.join(f"{field}_{direction}" for field, direction in keys)
+
+def ensure_indexes():
+    # create_index is a no-op for indexes that already exist with the same spec
+    created, failed = [], []
+    for collection, indexes in INDEXES.items():
+        for keys, options in indexes:
+            name = f"{collection.name}.{index_name(keys)}"
+            try:
+                collection.create_index(keys, name=index_name(keys), **options)
+                created.append(name)
+            except OperationFailure as e:
+                failed.append({'index': name, 'error': str(e)})
+    return {'ensured': created, 'failed': failed}
+
+def index_report():
+    missing, unused = [], []
+    for collection, indexes in INDEXES.items():
+        existing = collection.index_information()
+        for keys, _ in indexes:
+            if index_name(keys) not in existing:
+                missing.append(f"{collection.name}.{index_name(keys)}")
+        
+        for stats in collection.aggregate([{'$indexStats': {}}]):
+            if stats['name'] != '_id_' and stats['accesses']['ops'] == 0:
+                unused.append(f"{collection.name}.{stats['name']}")
+    return {'missing': missing, 'unused': unused}
+
+@app.cli.command('ensure-indexes')
+def ensure_indexes_command():
+    result = ensure_indexes()
+    for name in result['ensured']:
+        click.echo(f"ensured {name}")
+    for failure in result['failed']:
+        click.echo(f"FAILED {failure['index']}: {failure['error']}", err=True)
+    
+    report = index_report()
+    for name in report['missing']:
+        click.echo(f"missing {name}")
+    for name in report['unused']:
+        click.echo(f"unused {name} (no accesses since server start)")
+
+# Caches
+class TTLCache:
+    # Bounded LRU cache whose entries also expire after ttl seconds
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+        
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+            
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
+
+user_cache = TTLCache(
+    maxsize=int(os.environ.get('USER_CACHE_SIZE', 10000)),
+    ttl=int(os.environ.get('USER_CACHE_TTL', 30))
+)
+
+def load_user(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        user = users_collection.find_one({'_id': ObjectId(user_id)}, USER_PROJECTION)
+        if not user:
+            return None
+        user_cache.set(user_id, user)
+    # Routes modify current_user before returning it, so never hand out the cached dict
+    return dict(user)
+
+def invalidate_user(user_id):
+    user_cache.delete(str(user_id))
+
+class RedisCache:
+    # Shared cache backend so every worker sees the same content and invalidations
+    def __init__(self, url, ttl=300, prefix='content:'):
+        self.ttl = ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self._redis = redis.Redis.from_url(url)
+        
+    def get(self, key):
+        raw = self._redis.get(self.prefix + key)
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+    
+    def set(self, key, value):
+        self._redis.setex(self.prefix + key, self.ttl, json.dumps(value))
+        
+    def delete(self, key):
+        self._redis.delete(self.prefix + key)
+        
+    def clear(self):
+        for key in self._redis.scan_iter(match=self.prefix + '*'):
+            self._redis.delete(key)
+            
+    def stats(self):
+        return {'backend': 'redis', 'hits': self.hits, 'misses': self.misses}
+
+def create_content_cache():
+    ttl = int(os.environ.get('CONTENT_CACHE_TTL', 300))
+    url = os.environ.get('CONTENT_CACHE_URL')
+    if url:
+        if redis is not None:
+            return RedisCache(url, ttl=ttl)
+        print('CONTENT_CACHE_URL is set but redis is not installed, using the in-process content cache')
+    return TTLCache(maxsize=int(os.environ.get('CONTENT_CACHE_SIZE', 5000)), ttl=ttl)
+
+content_cache = create_content_cache()
+
+# Content cache entries hold the serialized response body plus whatever
+# request-independent fields the route still needs to look at
+def content_entry(payload, documents, **meta):
+    # The version of an entry is derived from the _id/updated_at of every
+    # document it was built from, so any admin edit produces a new ETag
+    versions = [(str(doc['_id']), str(doc.get('updated_at')), doc.get('lesson_count')) for doc in documents]
+    updated = [doc['updated_at'] for doc in documents if doc.get('updated_at')]
+    
+    return dict(
+        meta,
+        body=app.json.dumps(payload),
+        etag=hashlib.sha1(repr(versions).encode()).hexdigest(),
+        last_modified=calendar.timegm(max(updated).utctimetuple()) if updated else None
+    )
+
+def cached_content(key, loader):
+    entry = content_cache.get(key)
+    if entry is None:
+        entry = loader()
+        if entry is None:
+            return None
+        content_cache.set(key, entry)
+    return entry
+
+def content_response(entry, private=False):
+    last_modified = None
+    if entry.get('last_modified') is not None:
+        last_modified = datetime.fromtimestamp(entry['last_modified'], timezone.utc)
+    
+    # Answer revalidations before touching the body
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(entry['etag'])
+    else:
+        not_modified = bool(last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
+    
+    if not_modified:
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(entry['body'], mimetype='application/json')
+        
+    response.set_etag(entry['etag'])
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'private, no-cache' if private else 'public, no-cache'
+    return response
+
+def stream_json_array(documents):
+    # Encodes one document at a time so large listings never sit in memory whole
+    def generate():
+        yield '['
+        for i, document in enumerate(documents):
+            yield (',' if i else '') + app.json.dumps(document)
+        yield ']'
+    return app.response_class(generate(), mimetype='application/json')
+
+# Projections
+USER_PROJECTION = {'password': 0, 'pending_awards': 0}
+COURSE_CARD_PROJECTION = {
+    'title': 1, 'description': 1, 'category': 1, 'difficulty': 1,
+    'thumbnail': 1, 'duration': 1, 'is_free': 1, 'price': 1, 'is_published': 1
+}
+# Lesson content (notes, quiz questions and answers) is only sent by get_lesson
+LESSON_OUTLINE_PROJECTION = {'content': 0}
+
+def projection_arg(default=None):
+    # fields=title,category narrows the returned documents; _id is always kept
+    fields = request.args.get('fields')
+    if not fields:
+        return default
+    return {field.strip(): 1 for field in fields.split(',') if field.strip() and field.strip() != 'password'}
+
+# Pagination
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 200))
+
+class InvalidCursor(ValueError):
+    pass
+
+def encode_cursor(document, sort_fields):
+    values = [document[field] for field in sort_fields]
+    return base64.urlsafe_b64encode(app.json.dumps(values).encode()).decode()
+
+def decode_cursor(cursor, sort_fields):
+    # Sort keys always end with _id so that every position is unique
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if len(values) != len(sort_fields):
+            raise ValueError(cursor)
+        values[-1] = ObjectId(values[-1])
+    except Exception:
+        raise InvalidCursor(cursor)
+    return values
+
+def keyset_filter(sort_fields, values):
+    # (a, b, _id) > (x, y, z) as a query: a > x or (a == x and b > y) or ...
+    clauses = []
+    for i, field in enumerate(sort_fields):
+        clause = {f: v for f, v in zip(sort_fields[:i], values[:i])}
+        clause[field] = {'$gt': values[i]}
+        clauses.append(clause)
+    return {'$or': clauses} if len(clauses) > 1 else clauses[0]
+
+def page_args():
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return limit, request.args.get('after')
+
+def page_response(documents, limit, sort_fields):
+    # documents holds up to limit + 1 items; the extra one only signals another page
+    response = jsonify(documents[:limit])
+    if len(documents) > limit:
+        response.headers['X-Next-Cursor'] = encode_cursor(documents[limit - 1], sort_fields)
+    return response
+
+def paginate(collection, query, sort_fields=('_id',), projection=None):
+    # Without a limit the whole listing is streamed; with one, a single page is
+    # returned and X-Next-Cursor points at the next one
+    sort_fields = list(sort_fields)
+    limit, after = page_args()
+    if after:
+        try:
+            values = decode_cursor(after, sort_fields)
+        except InvalidCursor:
+            return jsonify({'error': 'Invalid cursor'}), 400
+        query = {'$and': [query, keyset_filter(sort_fields, values)]}
+        
+    if projection and all(projection.values()):
+        # The cursor of the next page is built from the sort fields
+        projection = dict(projection, **{field: 1 for field in sort_fields})
+        
+    cursor = collection.find(query, projection).sort([(field, ASCENDING) for field in sort_fields])
+    if not limit:
+        return stream_json_array(cursor)
+    return page_response(list(cursor.limit(limit + 1)), limit, sort_fields)
+
+def invalidate_content(course_id=None, lesson_id=None):
+    content_cache.delete('catalog:all')
+    content_cache.delete('catalog:featured')
+    if course_id:
+        content_cache.delete(f"course:{course_id}")
+    if lesson_id:
+        content_cache.delete(f"lesson:{lesson_id}")
+        content_cache.delete(f"answer_key:{lesson_id}")
+
+# Progress write-behind
+def progress_key(user_id, course_id, lesson_id):
+    return (str(user_id), course_id, lesson_id)
+
+class ProgressWriteBuffer:
+    # Video heartbeats only need their latest value persisted, so they are kept per
+    # (user, course, lesson) and written with one bulk_write per flush
+    def __init__(self, collection, interval=5, max_pending=500):
+        self.collection = collection
+        self.interval = interval
+        self.max_pending = max_pending
+        self.flushed = 0
+        self.coalesced = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._started = False
+        
+    def add(self, key, fields):
+        with self._lock:
+            if key in self._pending:
+                self.coalesced += 1
+            self._pending[key] = fields
+            full = len(self._pending) >= self.max_pending
+            start = not self._started
+            self._started = True
+            
+        if start:
+            socketio.start_background_task(self._run)
+        if full:
+            # The heartbeat is already buffered and a failed batch is re-queued,
+            # so a write error is the background flush's problem, not this request's
+            try:
+                self.flush()
+            except PyMongoError as e:
+                print(f"Progress flush failed: {e}")
+            
+    def get(self, key):
+        with self._lock:
+            return self._pending.get(key)
+        
+    def discard(self, keys):
+        # Called before writes that must not be overwritten by an older heartbeat
+        with self._lock:
+            for key in keys:
+                self._pending.pop(key, None)
+                
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+            
+        operations = [
+            UpdateOne(
+                {'user_id': user_id, 'course_id': course_id, 'lesson_id': lesson_id},
+                {'$set': fields},
+                upsert=True
+            )
+            for (user_id, course_id, lesson_id), fields in pending.items()
+        ]
+        try:
+            self.collection.bulk_write(operations, ordered=False)
+        except PyMongoError:
+            # Put the batch back unless a newer heartbeat arrived meanwhile
+            with self._lock:
+                for key, fields in pending.items():
+                    self._pending.setdefault(key, fields)
+            raise
+            
+        self.flushed += len(operations)
+        return len(operations)
+    
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Progress flush failed: {e}")
+                
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {'pending': pending, 'flushed': self.flushed, 'coalesced': self.coalesced}
+
+progress_buffer = ProgressWriteBuffer(
+    progress_collection,
+    interval=float(os.environ.get('PROGRESS_FLUSH_INTERVAL', 5)),
+    max_pending=int(os.environ.get('PROGRESS_FLUSH_MAX_PENDING', 500))
+)
+
+# Chat persistence
+class MessageWriteBuffer:
+    # Chat messages are appended in memory and written with one insert_many per flush
+    def __init__(self, collection, interval=1, max_pending=200):
+        self.collection = collection
+        self.interval = interval
+        self.max_pending = max_pending
+        self.flushed = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        self._started = False
+        
+    def add(self, message):
+        # Ids are assigned now so emitted and stored copies agree and order is stable
+        message.setdefault('_id', ObjectId())
+        with self._lock:
+            self._pending.append(message)
+            full = len(self._pending) >= self.max_pending
+            start = not self._started
+            self._started = True
+            
+        if start:
+            socketio.start_background_task(self._run)
+        if full:
+            # The message is buffered and failed writes are re-queued, so the
+            # background flush retries them instead of this request failing
+            try:
+                self.flush()
+            except PyMongoError as e:
+                print(f"Message flush failed: {e}")
+        return message
+    
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+            
+        try:
+            self.collection.insert_many(pending, ordered=False)
+        except BulkWriteError as e:
+            # Duplicate ids mean an earlier attempt already stored those messages
+            failed = {error['index'] for error in e.details['writeErrors'] if error['code'] != 11000}
+            with self._lock:
+                self._pending[:0] = [message for i, message in enumerate(pending) if i in failed]
+            raise
+        except PyMongoError:
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+            
+        self.flushed += len(pending)
+        return len(pending)
+    
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Message flush failed: {e}")
+                
+    def stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {'pending': pending, 'flushed': self.flushed}
+
+message_buffer = MessageWriteBuffer(
+    messages_collection,
+    interval=float(os.environ.get('MESSAGE_FLUSH_INTERVAL', 1)),
+    max_pending=int(os.environ.get('MESSAGE_FLUSH_MAX_PENDING', 200))
+)
+
+MESSAGE_RETENTION_DAYS = int(os.environ.get('MESSAGE_RETENTION_DAYS', 30))
+ARCHIVE_CHUNK_SIZE = int(os.environ.get('MESSAGE_ARCHIVE_CHUNK_SIZE', 500))
+
+def archive_messages(older_than_days=MESSAGE_RETENTION_DAYS):
+    # Moves old messages into one compact archive document per session chunk, so
+    # the messages collection only holds recent conversation
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    archived = 0
+    
+    for session in messages_collection.aggregate([
+        {'$match': {'timestamp': {'$lt': cutoff}}},
+        {'$group': {'_id': '$session_id'}}
+    ]):
+        session_id = session['_id']
+        while True:
+            messages = list(messages_collection.find(
+                {'session_id': session_id, 'timestamp': {'$lt': cutoff}},
+                {'session_id': 0}
+            ).sort([('timestamp', ASCENDING), ('_id', ASCENDING)]).limit(ARCHIVE_CHUNK_SIZE))
+            if not messages:
+                break
+                
+            message_archives_collection.insert_one({
+                'session_id': session_id,
+                'from': messages[0]['timestamp'],
+                'to': messages[-1]['timestamp'],
+                'count': len(messages),
+                'messages': messages,
+                'archived_at': datetime.utcnow()
+            })
+            messages_collection.delete_many({'_id': {'$in': [message['_id'] for message in messages]}})
+            archived += len(messages)
+            socketio.sleep(0)
+            
+    return archived
+
+SESSION_RETENTION_DAYS = int(os.environ.get('SESSION_RETENTION_DAYS', 90))
+
+def expire_sessions(retention_days=SESSION_RETENTION_DAYS):
+    # Sessions nobody has touched for retention_days go together with their
+    # messages and archives; a TTL on sessions alone would orphan both
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    stale = {'$or': [
+        {'last_active_at': {'$lt': cutoff}},
+        # Sessions started before last_active_at was tracked
+        {'last_active_at': None, 'created_at': {'$lt': cutoff}}
+    ]}
+    expired = 0
+    while True:
+        session_ids = [
+            session['session_id']
+            for session in sessions_collection.find(stale, {'session_id': 1}).limit(ARCHIVE_CHUNK_SIZE)
+        ]
+        if not session_ids:
+            return expired
+            
+        # Sessions first, still only if stale, so one resumed meanwhile keeps its history
+        sessions_collection.delete_many({'session_id': {'$in': session_ids}, **stale})
+        resumed = {session['session_id'] for session in sessions_collection.find({'session_id': {'$in': session_ids}}, {'session_id': 1})}
+        session_ids = [session_id for session_id in session_ids if session_id not in resumed]
+        messages_collection.delete_many({'session_id': {'$in': session_ids}})
+        message_archives_collection.delete_many({'session_id': {'$in': session_ids}})
+        expired += len(session_ids)
+        socketio.sleep(0)
+
+def archive_messages_periodically(interval):
+    # Enable on one node only; concurrent runs would archive the same chunk twice
+    while True:
+        socketio.sleep(interval)
+        try:
+            archive_messages()
+            expire_sessions()
+        except Exception as e:
+            print(f"Message archival failed: {e}")
+
+@app.cli.command('archive-messages')
+@click.option('--days', default=MESSAGE_RETENTION_DAYS, show_default=True, help='Archive messages older than this many days.')
+def archive_messages_command(days):
+    click.echo(f"archived {archive_messages(days)} messages")
+
+@app.cli.command('expire-sessions')
+@click.option('--days', default=SESSION_RETENTION_DAYS, show_default=True, help='Delete sessions inactive for this many days, with their messages.')
+def expire_sessions_command(days):
+    click.echo(f"expired {expire_sessions(days)} sessions")
+
+# Leaderboard
+class Leaderboard:
+    # Users ordered by (points, streak) in a sorted list, so rank lookups are a
+    # bisect and the top of the board is a slice
+    def __init__(self):
+        self._scores = {}
+        self._ranking = []
+        self._lock = threading.Lock()
+        
+    def load(self, scores):
+        with self._lock:
+            self._scores = dict(scores)
+            self._ranking = sorted((-points, -streak, user_id) for user_id, (points, streak) in self._scores.items())
+            
+    def update(self, user_id, points_delta=0, streak=None, points=None):
+        # points sets the total outright, for changes that carry the new value
+        with self._lock:
+            old_points, old_streak = self._scores.get(user_id, (0, 0))
+            if user_id in self._scores:
+                i = bisect.bisect_left(self._ranking, (-old_points, -old_streak, user_id))
+                del self._ranking[i]
+            score = (
+                (old_points if points is None else points) + points_delta,
+                old_streak if streak is None else streak
+            )
+            self._scores[user_id] = score
+            bisect.insort(self._ranking, (-score[0], -score[1], user_id))
+            
+    def rank(self, user_id):
+        with self._lock:
+            if user_id not in self._scores:
+                return None
+            points, streak = self._scores[user_id]
+            # Position of the first entry with this exact score; ties share a rank
+            return bisect.bisect_left(self._ranking, (-points, -streak, '')) + 1
+        
+    def score(self, user_id):
+        with self._lock:
+            return self._scores.get(user_id, (0, 0))
+        
+    def top(self, limit, offset=0):
+        with self._lock:
+            entries = self._ranking[offset:offset + limit]
+        return [
+            {'user_id': user_id, 'points': -points, 'streak': -streak}
+            for points, streak, user_id in entries
+        ]
+    
+    def __len__(self):
+        return len(self._ranking)
+
+global_leaderboard = Leaderboard()
+course_leaderboards = {}
+leaderboards_loaded = threading.Event()
+
+def load_leaderboards():
+    global_leaderboard.load({
+        str(user['_id']): (user.get('points', 0), user.get('streak', 0))
+        for user in users_collection.find({}, {'points': 1, 'streak': 1})
+    })
+    
+    # Per-course boards are built from the points each user earned in that course
+    scores = {}
+    for item in points_ledger_collection.aggregate([
+        {'$group': {'_id': {'course_id': '$course_id', 'user_id': '$user_id'}, 'points': {'$sum': '$points'}}}
+    ]):
+        scores.setdefault(item['_id']['course_id'], {})[item['_id']['user_id']] = (item['points'], 0)
+    
+    boards = {}
+    for course_id, course_scores in scores.items():
+        boards[course_id] = Leaderboard()
+        boards[course_id].load(course_scores)
+    course_leaderboards.clear()
+    course_leaderboards.update(boards)
+    leaderboards_loaded.set()
+
+def get_leaderboard(course_id=None):
+    if not leaderboards_loaded.is_set():
+        load_leaderboards()
+    if course_id:
+        return course_leaderboards.get(course_id) or Leaderboard()
+    return global_leaderboard
+
+# Ledger entries this worker already put on its course boards, so the change
+# stream does not count them a second time
+applied_ledger_entries = TTLCache(maxsize=10000, ttl=600)
+
+def record_points(user_id, course_id, points, entry_id=None):
+    # Boards that have not been loaded yet will pick the change up when they are
+    if not points or not leaderboards_loaded.is_set():
+        return
+    if entry_id is not None:
+        applied_ledger_entries.set(str(entry_id), True)
+    global_leaderboard.update(str(user_id), points_delta=points)
+    course_leaderboards.setdefault(course_id, Leaderboard()).update(str(user_id), points_delta=points)
+
+LEADERBOARD_CHANGES = [{'$match': {'$or': [
+    {'ns.coll': points_ledger_collection.name, 'operationType': 'insert'},
+    {'ns.coll': users_collection.name, 'operationType': 'update', '$or': [
+        {'updateDescription.updatedFields.points': {'$exists': True}},
+        {'updateDescription.updatedFields.streak': {'$exists': True}}
+    ]}
+]}}]
+# Raised by servers that are not replica set members
+CHANGE_STREAMS_UNSUPPORTED = 40573
+
+def apply_leaderboard_change(change):
+    if not leaderboards_loaded.is_set():
+        return
+    if change['ns']['coll'] == points_ledger_collection.name:
+        entry = change['fullDocument']
+        if entry['points'] and applied_ledger_entries.get(str(entry['_id'])) is None:
+            course_leaderboards.setdefault(entry['course_id'], Leaderboard()).update(entry['user_id'], points_delta=entry['points'])
+    else:
+        # users updates carry the new totals, so replaying one is harmless
+        fields = change['updateDescription']['updatedFields']
+        global_leaderboard.update(str(change['documentKey']['_id']), points=fields.get('points'), streak=fields.get('streak'))
+
+def follow_leaderboards(fallback_interval):
+    # Applies every worker's awards and streaks as they are written. The full
+    # load happens at startup and again only if the stream lost its place.
+    resume_token = None
+    delay = 1
+    while True:
+        try:
+            with db.watch(LEADERBOARD_CHANGES, resume_after=resume_token) as stream:
+                for change in stream:
+                    apply_leaderboard_change(change)
+                    resume_token = stream.resume_token
+                    delay = 1
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                print('Change streams need a replica set; reloading leaderboards periodically instead')
+                return refresh_leaderboards(fallback_interval)
+            # The stream cannot resume (e.g. its history rolled off the oplog),
+            # so whatever happened meanwhile is only in a full load
+            print(f"Leaderboard change stream failed: {e}")
+            resume_token = None
+            socketio.sleep(delay)
+            delay = min(delay * 2, fallback_interval)
+            try:
+                load_leaderboards()
+            except PyMongoError as e:
+                print(f"Leaderboard reload failed: {e}")
+        except PyMongoError as e:
+            # Transient; the resume token picks up where the stream stopped
+            print(f"Leaderboard change stream interrupted: {e}")
+            socketio.sleep(delay)
+            delay = min(delay * 2, fallback_interval)
+
+def refresh_leaderboards(interval):
+    # Without change streams, reloading bounds how stale this copy gets
+    while True:
+        socketio.sleep(interval)
+        try:
+            load_leaderboards()
+        except Exception as e:
+            print(f"Leaderboard refresh failed: {e}")
+
+# Points
+def ledger_entry(user_id, course_id, lesson_id, points, reason):
+    entry = {
+        'user_id': str(user_id),
+        'course_id': course_id,
+        'lesson_id': lesson_id,
+        'points': points,
+        'reason': reason,
+        'awarded_at': datetime.utcnow()
+    }
+    if points:
+        # Cleared by credit_points once users.points includes the award
+        entry['status'] = 'pending'
+    return entry
+
+def credit_points(user_id, entries):
+    # The ledger entry and the users $inc are separate writes. The $inc also
+    # parks the entry ids on the user, so running this again after a crash
+    # (see credit_pending_points) never adds the same award twice.
+    ids = [entry['_id'] for entry in entries]
+    points = sum(entry['points'] for entry in entries)
+    users_collection.update_one(
+        {'_id': ObjectId(user_id), 'pending_awards': {'$nin': ids}},
+        {'$inc': {'points': points}, '$addToSet': {'pending_awards': {'$each': ids}}}
+    )
+    points_ledger_collection.update_many({'_id': {'$in': ids}}, {'$unset': {'status': ''}})
+    users_collection.update_one({'_id': ObjectId(user_id)}, {'$pull': {'pending_awards': {'$in': ids}}})
+    invalidate_user(user_id)
+
+def award_points(user_id, course_id, lesson_id, points, reason):
+    # The unique (user_id, lesson_id) ledger index decides whether this is the first
+    # award, so retries and double submits neither add points nor write to users
+    entry = ledger_entry(user_id, course_id, lesson_id, points, reason)
+    try:
+        points_ledger_collection.insert_one(entry)
+    except DuplicateKeyError:
+        return 0
+        
+    if points:
+        credit_points(user_id, [entry])
+        record_points(user_id, course_id, points, entry['_id'])
+    return points
+
+def award_points_batch(user_id, awards):
+    # awards: (course_id, lesson_id, points, reason) tuples, written in one insert_many
+    if not awards:
+        return 0
+    entries = [ledger_entry(user_id, *award) for award in awards]
+    duplicates = set()
+    try:
+        points_ledger_collection.insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        for error in e.details['writeErrors']:
+            if error['code'] != 11000:
+                raise
+            duplicates.add(error['index'])
+            
+    awarded = [entry for i, entry in enumerate(entries) if i not in duplicates and entry['points']]
+    points = sum(entry['points'] for entry in awarded)
+    if points:
+        credit_points(user_id, awarded)
+        for entry in awarded:
+            record_points(user_id, entry['course_id'], entry['points'], entry['_id'])
+    return points
+
+def credit_pending_points(older_than=60):
+    # Awards whose worker died between the ledger insert and the users update
+    cutoff = datetime.utcnow() - timedelta(seconds=older_than)
+    credited = 0
+    for entry in points_ledger_collection.find({'status': 'pending', 'awarded_at': {'$lt': cutoff}}):
+        credit_points(entry['user_id'], [entry])
+        credited += 1
+    return credited
+
+def credit_pending_points_periodically(interval):
+    while True:
+        socketio.sleep(interval)
+        try:
+            credit_pending_points()
+        except Exception as e:
+            print(f"Crediting pending points failed: {e}")
+
+POINTS_BATCH_SIZE = int(os.environ.get('POINTS_BATCH_SIZE', 1000))
+
+def seed_ledger(rows, durations):
+    lesson_ids = set()
+    for row in rows:
+        if row['lesson_id'] not in durations:
+            try:
+                lesson_ids.add(ObjectId(row['lesson_id']))
+            except (InvalidId, TypeError):
+                durations[row['lesson_id']] = 0
+    for lesson in lessons_collection.find({'_id': {'$in': list(lesson_ids)}}, {'duration': 1}):
+        durations[str(lesson['_id'])] = lesson.get('duration', 0)
+    
+    entries = []
+    for row in rows:
+        # Lessons deleted since they were completed no longer say what they paid
+        entry = ledger_entry(row['user_id'], row['course_id'], row['lesson_id'], durations.get(row['lesson_id'], 0) * 2, 'backfill')
+        entry['awarded_at'] = row.get('updated_at') or entry['awarded_at']
+        # Already part of users.points, so there is nothing left to credit
+        entry.pop('status', None)
+        entries.append(entry)
+    try:
+        return len(points_ledger_collection.insert_many(entries, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(error['code'] != 11000 for error in e.details['writeErrors']):
+            raise
+        return e.details['nInserted']
+
+def backfill_points_ledger():
+    # Lessons completed before the ledger existed were already paid into
+    # users.points. Seeding their entries (without touching users) stops
+    # award_points from paying them again; the unique index makes reruns no-ops.
+    seeded = 0
+    durations = {}
+    rows = []
+    for row in progress_collection.find({'completed': True}, {'user_id': 1, 'course_id': 1, 'lesson_id': 1, 'updated_at': 1}):
+        rows.append(row)
+        if len(rows) >= POINTS_BATCH_SIZE:
+            seeded += seed_ledger(rows, durations)
+            rows = []
+    if rows:
+        seeded += seed_ledger(rows, durations)
+    return seeded
+
+def rebuild_user_points():
+    # Without the backfill, everything earned before the ledger would be wiped
+    backfill_points_ledger()
+    credit_pending_points(older_than=0)
+    
+    # Zero everyone first so users without ledger entries need no id list
+    users_collection.update_many({'points': {'$ne': 0}}, {'$set': {'points': 0}})
+    rebuilt = 0
+    updates = []
+    for item in points_ledger_collection.aggregate([
+        {'$group': {'_id': '$user_id', 'points': {'$sum': '$points'}}}
+    ], allowDiskUse=True):
+        updates.append(UpdateOne({'_id': ObjectId(item['_id'])}, {'$set': {'points': item['points']}}))
+        if len(updates) >= POINTS_BATCH_SIZE:
+            rebuilt += users_collection.bulk_write(updates, ordered=False).matched_count
+            updates = []
+    if updates:
+        rebuilt += users_collection.bulk_write(updates, ordered=False).matched_count
+    user_cache.clear()
+    load_leaderboards()
+    return rebuilt
+
+@app.cli.command('backfill-points')
+def backfill_points_command():
+    # Run once before serving the ledger-based award paths
+    click.echo(f"seeded {backfill_points_ledger()} ledger entries from completed lessons")
+
+@app.cli.command('rebuild-points')
+def rebuild_points_command():
+    click.echo(f"rebuilt points for {rebuild_user_points()} users from the ledger")
+
+# Admin metrics
+# Totals live in one counters document that write paths $inc, so the admin
+# dashboard never counts whole collections
+METRICS_ID = 'totals'
+PREMIUM_ENROLLMENT_PRICE = 19.99
+
+admin_stats_cache = TTLCache(maxsize=1, ttl=int(os.environ.get('ADMIN_STATS_TTL', 30)))
+
+def count_metrics(exact=False):
+    count = (lambda collection: collection.count_documents({})) if exact else (lambda collection: collection.estimated_document_count())
+    return {
+        'courses': count(courses_collection),
+        'users': count(users_collection),
+        'lessons': count(lessons_collection),
+        'enrollments': count(enrollments_collection),
+        'premium_enrollments': enrollments_collection.count_documents({'is_premium': True})
+    }
+
+def load_metrics():
+    metrics = metrics_collection.find_one({'_id': METRICS_ID})
+    if metrics is None:
+        # Seed once; increments made before the seed are already in the counts
+        metrics = count_metrics()
+        metrics_collection.update_one({'_id': METRICS_ID}, {'$setOnInsert': metrics}, upsert=True)
+    return metrics
+
+def bump_metrics(**deltas):
+    # No upsert: until the counters are seeded there is nothing to keep in step
+    deltas = {name: delta for name, delta in deltas.items() if delta}
+    if deltas:
+        metrics_collection.update_one({'_id': METRICS_ID}, {'$inc': deltas})
+
+@app.cli.command('recount-metrics')
+def recount_metrics_command():
+    metrics = count_metrics(exact=True)
+    metrics_collection.update_one({'_id': METRICS_ID}, {'$set': metrics}, upsert=True)
+    for name, value in metrics.items():
+        click.echo(f"{name}: {value}")
+
+# Background jobs
+COURSE_DELETE_BATCH_SIZE = int(os.environ.get('COURSE_DELETE_BATCH_SIZE', 500))
+COURSE_DELETE_PAUSE = float(os.environ.get('COURSE_DELETE_PAUSE', 0.05))
+
+# A running job holds a lease its worker renews after every batch; a job whose
+# lease ran out belongs to a worker that died and may be claimed by another
+JOB_LEASE_SECONDS = int(os.environ.get('JOB_LEASE_SECONDS', 60))
+
+class JobLeaseLost(Exception):
+    pass
+
+def job_owner():
+    # Resolved per call, so forked workers never share an owner id
+    return f"{platform.node()}:{os.getpid()}"
+
+def claim_job(job_id):
+    now = datetime.utcnow()
+    return jobs_collection.find_one_and_update(
+        {
+            '_id': job_id,
+            '$or': [
+                {'status': 'pending'},
+                {'status': 'running', 'lease_until': {'$lt': now}}
+            ]
+        },
+        {'$set': {
+            'status': 'running',
+            'owner': job_owner(),
+            'lease_until': now + timedelta(seconds=JOB_LEASE_SECONDS),
+            'updated_at': now
+        }},
+        return_document=ReturnDocument.AFTER
+    )
+
+def update_job(job_id, **fields):
+    update = {'$set': dict(fields, updated_at=datetime.utcnow())}
+    jobs_collection.update_one({'_id': job_id}, update)
+
+def renew_job(job_id, **increments):
+    now = datetime.utcnow()
+    result = jobs_collection.update_one(
+        {'_id': job_id, 'owner': job_owner(), 'status': 'running'},
+        {
+            '$set': {'lease_until': now + timedelta(seconds=JOB_LEASE_SECONDS), 'updated_at': now},
+            '$inc': increments
+        }
+    )
+    if not result.matched_count:
+        raise JobLeaseLost()
+
+def delete_in_batches(collection, query, job_id, name, before_delete=None, metric=None):
+    # Deletes by _id batches so no single operation holds the server for long.
+    # Metrics follow each batch, so a job that dies midway leaves them correct.
+    deleted = 0
+    while True:
+        documents = list(collection.find(query, {'_id': 1}).limit(COURSE_DELETE_BATCH_SIZE))
+        if not documents:
+            return deleted
+        ids = [document['_id'] for document in documents]
+        if before_delete:
+            before_delete(ids)
+        count = collection.delete_many({'_id': {'$in': ids}}).deleted_count
+        deleted += count
+        if metric:
+            bump_metrics(**{metric: -count})
+        renew_job(job_id, **{f"deleted.{name}": count})
+        socketio.sleep(COURSE_DELETE_PAUSE)
+
+def run_course_deletion(job_id):
+    job = claim_job(job_id)
+    if not job:
+        # Finished, or another live worker holds the lease
+        return
+    course_id = job['course_id']
+    
+    def delete_lesson_dependents(lesson_ids):
+        lesson_ids = [str(lesson_id) for lesson_id in lesson_ids]
+        count = bookmarks_collection.delete_many({'lesson_id': {'$in': lesson_ids}}).deleted_count
+        jobs_collection.update_one({'_id': job_id}, {'$inc': {'deleted.bookmarks': count}})
+        for lesson_id in lesson_ids:
+            content_cache.delete(f"lesson:{lesson_id}")
+            content_cache.delete(f"answer_key:{lesson_id}")
+    
+    def count_premium(enrollment_ids):
+        premium = enrollments_collection.count_documents({'_id': {'$in': enrollment_ids}, 'is_premium': True})
+        bump_metrics(premium_enrollments=-premium)
+    
+    try:
+        # Bookmarks only reference lessons, so they go with each lesson batch
+        delete_in_batches(lessons_collection, {'course_id': course_id}, job_id, 'lessons', delete_lesson_dependents, metric='lessons')
+        delete_in_batches(progress_collection, {'course_id': course_id}, job_id, 'progress')
+        delete_in_batches(enrollments_collection, {'course_id': course_id}, job_id, 'enrollments', count_premium, metric='enrollments')
+        update_job(job_id, status='done', finished_at=datetime.utcnow())
+    except JobLeaseLost:
+        print(f"Lost the lease on job {job_id}; another worker resumed it")
+    except Exception as e:
+        update_job(job_id, status='failed', error=str(e))
+
+def start_course_deletion(course_id):
+    job_id = jobs_collection.insert_one({
+        'type': 'course_delete',
+        'course_id': course_id,
+        'status': 'pending',
+        'deleted': {'lessons': 0, 'bookmarks': 0, 'progress': 0, 'enrollments': 0},
+        'created_at': datetime.utcnow(),
+        'updated_at': datetime.utcnow()
+    }).inserted_id
+    socketio.start_background_task(run_course_deletion, job_id)
+    return job_id
+
+def resume_jobs():
+    # Deletion batches are idempotent, so interrupted jobs simply run again; the
+    # claim in run_course_deletion keeps jobs another worker holds with it
+    query = {
+        'type': 'course_delete',
+        '$or': [
+            {'status': 'pending'},
+            {'status': 'running', 'lease_until': {'$lt': datetime.utcnow()}}
+        ]
+    }
+    for job in jobs_collection.find(query, {'_id': 1}):
+        socketio.start_background_task(run_course_deletion, job['_id'])
+
+def resume_jobs_periodically(interval):
+    # Picks up jobs whose worker died without another worker restarting
+    while True:
+        socketio.sleep(interval)
+        try:
+            resume_jobs()
+        except Exception as e:
+            print(f"Resuming jobs failed: {e}")
+
+# Password hashing
+# KDFs are deliberately slow, so they run in a process pool instead of on the
+# worker that also serves everything else. KDF_WORKERS=0 hashes inline.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+
+class KDFPoolSaturated(Exception):
+    pass
+
+class KDFPool:
+    def __init__(self, workers, max_pending, timeout):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self._executor = None
+        self._lock = threading.Lock()
+        
+    def _finished(self, future=None):
+        with self._lock:
+            self.pending -= 1
+            if future is None or not future.cancelled():
+                self.completed += 1
+                
+    def _reset(self, executor):
+        # A worker process died (e.g. OOM-killed) and took the executor with it;
+        # the next call starts a fresh one
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False)
+        
+    def run(self, fn, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise KDFPoolSaturated()
+            self.pending += 1
+            # Created on first use so the pool is started after gunicorn forks
+            if self.workers and self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            executor = self._executor
+            
+        if not self.workers:
+            try:
+                return fn(*args)
+            finally:
+                self._finished()
+                
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            self._finished()
+            self._reset(executor)
+            raise KDFPoolSaturated()
+        # Work stays pending until it actually leaves the executor, not when the
+        # caller gives up waiting on it
+        future.add_done_callback(self._finished)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self.timed_out += 1
+            raise KDFPoolSaturated()
+        except BrokenProcessPool:
+            self._reset(executor)
+            raise KDFPoolSaturated()
+                
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'pending': self.pending,
+                'maxPending': self.max_pending,
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'timedOut': self.timed_out
+            }
+
+kdf_workers = int(os.environ.get('KDF_WORKERS', os.cpu_count() or 1))
+kdf_pool = KDFPool(
+    workers=kdf_workers,
+    max_pending=int(os.environ.get('KDF_MAX_PENDING', max(kdf_workers, 1) * 8)),
+    timeout=float(os.environ.get('KDF_TIMEOUT', 10))
+)
+
+def hash_password(password):
+    return kdf_pool.run(generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def verify_password(password_hash, password):
+    return kdf_pool.run(check_password_hash, password_hash, password)
+
+current_hash_prefix = None
+
+def password_needs_rehash(password_hash):
+    # Stored hashes start with the method and cost they were made with, e.g.
+    # "scrypt:32768:8:1$...". Hashing once tells us how werkzeug expands the
+    # configured method, which may leave its parameters at their defaults.
+    global current_hash_prefix
+    if current_hash_prefix is None:
+        current_hash_prefix = hash_password('').split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != current_hash_prefix
+
+def kdf_overloaded():
+    response = jsonify({'error': 'Too many sign-in requests, please try again shortly'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+# Media
+# Uploads are stored under the sha256 of their bytes, so identical images are
+# kept once and a stored file never changes (which makes it cacheable forever)
+MEDIA_ROOT = os.path.abspath(os.environ.get('MEDIA_ROOT', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media')))
+# Stored on documents as a path, so the host and scheme are whatever serves the API
+MEDIA_PATH = '/media/'
+IMAGE_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+THUMBNAIL_WIDTHS = tuple(sorted(int(width) for width in os.environ.get('THUMBNAIL_WIDTHS', '320,640').split(',')))
+MEDIA_CHUNK_SIZE = 64 * 1024
+MEDIA_MAX_AGE = 31536000
+# For a ?w= request answered with the original while its variant may still appear
+MEDIA_FALLBACK_MAX_AGE = int(os.environ.get('MEDIA_FALLBACK_MAX_AGE', 300))
+
+media_pool = None
+media_pool_lock = threading.Lock()
+
+class UnsupportedMedia(ValueError):
+    pass
+
+def variant_name(digest, width):
+    return f"{digest}_{width}.webp"
+
+def generate_variants(path, digest, widths, media_root):
+    # Runs in the media process pool; writes each variant atomically
+    with Image.open(path) as image:
+        image.load()
+        for width in widths:
+            target = os.path.join(media_root, variant_name(digest, width))
+            if image.width <= width or os.path.exists(target):
+                continue
+            variant = image.copy()
+            variant.thumbnail((width, image.height))
+            if variant.mode not in ('RGB', 'RGBA'):
+                variant = variant.convert('RGBA')
+            fd, tmp = tempfile.mkstemp(dir=media_root, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                variant.save(f, 'WEBP', quality=80, method=4)
+            os.replace(tmp, target)
+
+def reset_media_pool(pool):
+    # A worker process died (e.g. OOM-killed on a large image) and took the
+    # executor with it; the next upload starts a fresh one
+    global media_pool
+    with media_pool_lock:
+        if media_pool is pool:
+            media_pool = None
+    pool.shutdown(wait=False)
+
+def report_variants(digest, pool):
+    def done(future):
+        if future.cancelled() or not future.exception():
+            return
+        print(f"Thumbnail variants failed for {digest}: {future.exception()}")
+        if isinstance(future.exception(), BrokenProcessPool):
+            reset_media_pool(pool)
+    return done
+
+def variants_missing(digest):
+    return any(not os.path.exists(os.path.join(MEDIA_ROOT, variant_name(digest, width))) for width in THUMBNAIL_WIDTHS)
+
+def schedule_variants(path, digest):
+    # Best effort: the original is already stored, so a failure here never fails the upload
+    global media_pool
+    if Image is None:
+        return
+    with media_pool_lock:
+        # Created on first use so the pool is started after gunicorn forks
+        if media_pool is None:
+            media_pool = ProcessPoolExecutor(max_workers=int(os.environ.get('MEDIA_WORKERS', 2)))
+        pool = media_pool
+    try:
+        future = pool.submit(generate_variants, path, digest, THUMBNAIL_WIDTHS, MEDIA_ROOT)
+    except BrokenProcessPool:
+        print(f"Media pool broken, thumbnail variants skipped for {digest}")
+        reset_media_pool(pool)
+        return
+    except Exception as e:
+        print(f"Could not schedule thumbnail variants for {digest}: {e}")
+        return
+    future.add_done_callback(report_variants(digest, pool))
+
+def store_upload(upload):
+    extension = upload.filename.rsplit('.', 1)[-1].lower() if '.' in upload.filename else ''
+    if extension not in IMAGE_EXTENSIONS:
+        raise UnsupportedMedia(extension)
+    
+    os.makedirs(MEDIA_ROOT, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp = tempfile.mkstemp(dir=MEDIA_ROOT, suffix='.upload')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in iter(lambda: upload.stream.read(MEDIA_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+    except Exception:
+        os.remove(tmp)
+        raise
+        
+    digest = digest.hexdigest()
+    filename = f"{digest}.{extension}"
+    path = os.path.join(MEDIA_ROOT, filename)
+    if os.path.exists(path):
+        os.remove(tmp)
+    else:
+        os.replace(tmp, path)
+    # Re-uploads also retry variants an earlier run failed to produce; images
+    # narrower than a width never get that variant and are skipped quickly
+    if variants_missing(digest):
+        schedule_variants(path, digest)
+    
+    return MEDIA_PATH + filename
 
 # JWT Token required decorator
 def token_required(f):
@@ -44,7 +1439,7 @@ def token_required(f):
             
         try:
             data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])
-            current_user = users_collection.find_one({'_id': ObjectId(data['user_id'])})
+            current_user = load_user(data['user_id'])
             if not current_user:
                 return jsonify({'error': 'User not found'}), 401
         except:
@@ -72,13 +1467,16 @@ def register():
     if not data or not data.get('username') or not data.get('email') or not data.get('password'):
         return jsonify({'error': 'Missing required fields'}), 400
         
-    if users_collection.find_one({'username': data['username']}):
+    if users_collection.find_one({'username': data['username']}, {'_id': 1}):
         return jsonify({'error': 'Username already exists'}), 400
         
-    if users_collection.find_one({'email': data['email']}):
+    if users_collection.find_one({'email': data['email']}, {'_id': 1}):
         return jsonify({'error': 'Email already exists'}), 400
         
-    hashed_password = generate_password_hash(data['password'])
+    try:
+        hashed_password = hash_password(data['password'])
+    except KDFPoolSaturated:
+        return kdf_overloaded()
     
     user = {
         'username': data['username'],
@@ -92,7 +1490,9 @@ def register():
     }
     
     user_id = users_collection.insert_one(user).inserted_id
-    user['_id'] = str(user_id)
+    bump_metrics(users=1)
+    if leaderboards_loaded.is_set():
+        global_leaderboard.update(str(user_id))
     
     # Generate token
     token = jwt.encode({
@@ -116,8 +1516,11 @@ def login():
         
     user = users_collection.find_one({'username': data['username']})
     
-    if not user or not check_password_hash(user['password'], data['password']):
-        return jsonify({'error': 'Invalid username or password'}), 401
+    try:
+        if not user or not verify_password(user['password'], data['password']):
+            return jsonify({'error': 'Invalid username or password'}), 401
+    except KDFPoolSaturated:
+        return kdf_overloaded()
     
     # Update last login and streak
     last_login = user.get('last_login', datetime.utcnow())
@@ -129,14 +1532,26 @@ def login():
         new_streak = user.get('streak', 0)
     else:
         new_streak = 1
+    
+    updates = {
+        'last_login': datetime.utcnow(),
+        'streak': new_streak
+    }
+    
+    # Upgrade hashes made with an older method or cost while the password is at hand
+    try:
+        if password_needs_rehash(user['password']):
+            updates['password'] = hash_password(data['password'])
+    except KDFPoolSaturated:
+        pass
         
     users_collection.update_one(
         {'_id': user['_id']},
-        {'$set': {
-            'last_login': datetime.utcnow(),
-            'streak': new_streak
-        }}
+        {'$set': updates}
     )
+    invalidate_user(user['_id'])
+    if leaderboards_loaded.is_set():
+        global_leaderboard.update(str(user['_id']), streak=new_streak)
     
     # Generate token
     token = jwt.encode({
@@ -144,8 +1559,8 @@ def login():
         'exp': datetime.utcnow() + timedelta(days=30)
     }, app.config['SECRET_KEY'])
     
-    user['_id'] = str(user['_id'])
     del user['password']
+    user.pop('pending_awards', None)
     
     return jsonify({
         'access_token': token,
@@ -155,50 +1570,99 @@ def login():
 @app.route('/api/auth/me', methods=['GET'])
 @token_required
 def get_current_user(current_user):
-    current_user['_id'] = str(current_user['_id'])
     if 'password' in current_user:
         del current_user['password']
     return jsonify(current_user)
 
 # Courses Routes
+# Catalog queries
+def catalog_courses(query, limit=None, sort=None):
+    # Courses with their published lesson count, computed in one aggregation
+    # instead of one count_documents per course
+    pipeline = [{'$match': query}]
+    if sort:
+        pipeline.append({'$sort': sort})
+    if limit:
+        pipeline.append({'$limit': limit})
+    pipeline += [
+        {'$lookup': {
+            'from': lessons_collection.name,
+            'let': {'course_id': {'$toString': '$_id'}},
+            'pipeline': [
+                {'$match': {'$expr': {'$and': [
+                    {'$eq': ['$course_id', '$$course_id']},
+                    {'$eq': ['$is_published', True]}
+                ]}}},
+                {'$group': {'_id': None, 'count': {'$sum': 1}}}
+            ],
+            'as': '_lesson_stats'
+        }},
+        {'$addFields': {
+            'lesson_count': {'$ifNull': [{'$arrayElemAt': ['$_lesson_stats.count', 0]}, 0]}
+        }},
+        {'$project': {'_lesson_stats': 0}}
+    ]
+    
+    return list(courses_collection.aggregate(pipeline))
+
 @app.route('/api/courses', methods=['GET'])
 def get_courses():
-    courses = list(courses_collection.find({'is_published': True}))
-    for course in courses:
-        course['_id'] = str(course['_id'])
-        course['lesson_count'] = lessons_collection.count_documents({'course_id': course['_id'], 'is_published': True})
-    return jsonify(courses)
+    limit, after = page_args()
+    if limit or after:
+        query = {'is_published': True}
+        if after:
+            try:
+                query['_id'] = {'$gt': decode_cursor(after, ['_id'])[0]}
+            except InvalidCursor:
+                return jsonify({'error': 'Invalid cursor'}), 400
+        limit = limit or MAX_PAGE_SIZE
+        courses = catalog_courses(query, limit=limit + 1, sort={'_id': 1})
+        return page_response(courses, limit, ['_id'])
+    
+    def load():
+        courses = catalog_courses({'is_published': True})
+        return content_entry(courses, courses)
+    
+    entry = cached_content('catalog:all', load)
+    return content_response(entry)
 
 @app.route('/api/courses/featured', methods=['GET'])
 def get_featured_courses():
-    courses = list(courses_collection.find({'is_published': True, 'is_featured': True}).limit(3))
-    for course in courses:
-        course['_id'] = str(course['_id'])
-        course['lesson_count'] = lessons_collection.count_documents({'course_id': course['_id'], 'is_published': True})
-    return jsonify(courses)
+    def load():
+        courses = catalog_courses({'is_published': True, 'is_featured': True}, limit=3)
+        return content_entry(courses, courses)
+    
+    entry = cached_content('catalog:featured', load)
+    return content_response(entry)
 
-@app.route('/api/courses/<course_id>', methods=['GET'])
-def get_course(course_id):
+def load_course_entry(course_id):
     course = courses_collection.find_one({'_id': ObjectId(course_id)})
     if not course:
-        return jsonify({'error': 'Course not found'}), 404
-        
-    course['_id'] = str(course['_id'])
+        return None
     
     # Get lessons
-    lessons = list(lessons_collection.find({'course_id': course_id, 'is_published': True}).sort('order', 1))
-    for lesson in lessons:
-        lesson['_id'] = str(lesson['_id'])
+    lessons = list(lessons_collection.find(
+        {'course_id': course_id, 'is_published': True},
+        LESSON_OUTLINE_PROJECTION
+    ).sort('order', 1))
     
     course['lessons'] = lessons
     
-    return jsonify(course)
+    return content_entry(course, [course] + lessons)
+
+@app.route('/api/courses/<course_id>', methods=['GET'])
+def get_course(course_id):
+    entry = cached_content(f"course:{course_id}", lambda: load_course_entry(course_id))
+    if not entry:
+        return jsonify({'error': 'Course not found'}), 404
+        
+    return content_response(entry)
 
 @app.route('/api/courses/enroll/<course_id>', methods=['POST'])
 @token_required
 def enroll_course(current_user, course_id):
     # Check if course exists
-    course = courses_collection.find_one({'_id': ObjectId(course_id)})
+    course = courses_collection.find_one({'_id': ObjectId(course_id)}, {'_id': 1})
     if not course:
         return jsonify({'error': 'Course not found'}), 404
         
@@ -206,7 +1670,7 @@ def enroll_course(current_user, course_id):
     enrollment = enrollments_collection.find_one({
         'user_id': str(current_user['_id']),
         'course_id': course_id
-    })
+    }, {'_id': 1})
     
     if enrollment:
         return jsonify({'error': 'Already enrolled in this course'}), 400
@@ -218,6 +1682,7 @@ def enroll_course(current_user, course_id):
         'enrolled_at': datetime.utcnow(),
         'completed': False
     })
+    bump_metrics(enrollments=1)
     
     return jsonify({'message': 'Successfully enrolled in course'}), 201
 
@@ -227,65 +1692,112 @@ def check_enrollment(current_user, course_id):
     enrollment = enrollments_collection.find_one({
         'user_id': str(current_user['_id']),
         'course_id': course_id
-    })
+    }, {'_id': 1})
     
     return jsonify({'isEnrolled': bool(enrollment)})
 
 # Lessons Routes
+def load_lesson_entry(lesson_id):
+    lesson = lessons_collection.find_one({'_id': ObjectId(lesson_id)})
+    if not lesson:
+        return None
+    
+    return content_entry(lesson, [lesson], course_id=lesson['course_id'], is_free=lesson.get('is_free', False))
+
 @app.route('/api/lessons/<lesson_id>', methods=['GET'])
 @token_required
 def get_lesson(current_user, lesson_id):
-    lesson = lessons_collection.find_one({'_id': ObjectId(lesson_id)})
-    if not lesson:
+    entry = cached_content(f"lesson:{lesson_id}", lambda: load_lesson_entry(lesson_id))
+    if not entry:
         return jsonify({'error': 'Lesson not found'}), 404
-        
-    lesson['_id'] = str(lesson['_id'])
     
     # Check if user is enrolled in the course
     enrollment = enrollments_collection.find_one({
         'user_id': str(current_user['_id']),
-        'course_id': lesson['course_id']
-    })
+        'course_id': entry['course_id']
+    }, {'_id': 1})
     
-    if not enrollment and not lesson.get('is_free', False):
+    if not enrollment and not entry['is_free']:
         return jsonify({'error': 'You need to enroll in this course first'}), 403
     
-    return jsonify(lesson)
+    return content_response(entry, private=True)
+
+# Quiz grading
+QUIZ_PASS_SCORE = 80
+
+def compile_answer_key(lesson):
+    # Deduplicated answers per question index, in a JSON-safe shape for content_cache
+    return {
+        'course_id': lesson['course_id'],
+        'duration': lesson.get('duration', 0),
+        'version': str(lesson.get('updated_at')),
+        'answers': [list(set(question['correct_answers'])) for question in lesson['content']['questions']]
+    }
+
+def load_answer_key(lesson_id):
+    # A pass is permanent in the points ledger, so a cached key is only used
+    # while it matches the lesson's updated_at. That check is a small _id read
+    # and holds on every node, including with the in-process content_cache
+    # where invalidate_content only evicts on the node that saved the edit.
+    lesson = lessons_collection.find_one({'_id': ObjectId(lesson_id)}, {'updated_at': 1})
+    if not lesson:
+        return None
+    answer_key = content_cache.get(f"answer_key:{lesson_id}")
+    if answer_key is None or answer_key['version'] != str(lesson.get('updated_at')):
+        lesson = lessons_collection.find_one(
+            {'_id': ObjectId(lesson_id)},
+            {'course_id': 1, 'lesson_type': 1, 'duration': 1, 'updated_at': 1, 'content.questions.correct_answers': 1}
+        )
+        if not lesson or lesson['lesson_type'] != 'quiz':
+            return None
+        answer_key = compile_answer_key(lesson)
+        content_cache.set(f"answer_key:{lesson_id}", answer_key)
+    return dict(answer_key, answers=tuple(frozenset(answers) for answers in answer_key['answers']))
+
+def grade_quiz(answer_key, answers):
+    correct = 0
+    for i, expected in enumerate(answer_key['answers']):
+        if frozenset(answers.get(str(i), ())) == expected:
+            correct += 1
+            
+    total = len(answer_key['answers'])
+    score = (correct / total) * 100
+    return {
+        'correct': correct,
+        'total': total,
+        'score': score,
+        'passed': score >= QUIZ_PASS_SCORE
+    }
+
+def grade_quiz_batch(answer_key, submissions):
+    return [grade_quiz(answer_key, submission.get('answers', {})) for submission in submissions]
 
 @app.route('/api/lessons/<lesson_id>/quiz', methods=['POST'])
 @token_required
 def submit_quiz(current_user, lesson_id):
     data = request.get_json()
-    lesson = lessons_collection.find_one({'_id': ObjectId(lesson_id)})
+    answer_key = load_answer_key(lesson_id)
     
-    if not lesson or lesson['lesson_type'] != 'quiz':
+    if not answer_key:
         return jsonify({'error': 'Quiz not found'}), 404
         
     # Calculate score
-    questions = lesson['content']['questions']
-    correct = 0
+    result = grade_quiz(answer_key, data.get('answers', {}))
     
-    for i, question in enumerate(questions):
-        user_answer = data.get('answers', {}).get(str(i), [])
-        correct_answer = question['correct_answers']
-        
-        if set(user_answer) == set(correct_answer):
-            correct += 1
-    
-    score = (correct / len(questions)) * 100
+    progress_buffer.discard([progress_key(current_user['_id'], answer_key['course_id'], lesson_id)])
     
     # Update progress
     progress_collection.update_one(
         {
             'user_id': str(current_user['_id']),
-            'course_id': lesson['course_id'],
+            'course_id': answer_key['course_id'],
             'lesson_id': lesson_id
         },
         {
             '$set': {
-                'quiz_score': score,
-                'progress': 1 if score >= 80 else 0.5,
-                'completed': score >= 80,
+                'quiz_score': result['score'],
+                'progress': 1 if result['passed'] else 0.5,
+                'completed': result['passed'],
                 'updated_at': datetime.utcnow()
             }
         },
@@ -293,53 +1805,60 @@ def submit_quiz(current_user, lesson_id):
     )
     
     # Add points if completed
-    if score >= 80:
-        points = lesson.get('duration', 0) * 2
-        users_collection.update_one(
-            {'_id': current_user['_id']},
-            {'$inc': {'points': points}}
-        )
+    if result['passed']:
+        award_points(current_user['_id'], answer_key['course_id'], lesson_id, answer_key['duration'] * 2, 'quiz')
     
-    return jsonify({
-        'correct': correct,
-        'total': len(questions),
-        'score': score,
-        'passed': score >= 80
-    })
+    return jsonify(result)
 
 # Progress Routes
-@app.route('/api/progress/<course_id>', methods=['GET'])
-@token_required
-def get_course_progress(current_user, course_id):
-    lessons = list(lessons_collection.find({'course_id': course_id}))
-    progress_items = list(progress_collection.find({
-        'user_id': str(current_user['_id']),
-        'course_id': course_id
-    }))
-    
-    # Calculate overall progress
-    total_lessons = len(lessons)
-    if total_lessons == 0:
-        return jsonify({'progress': 0, 'completedLessons': []})
+def count_lessons_by_course(course_ids):
+    counts = lessons_collection.aggregate([
+        {'$match': {'course_id': {'$in': list(course_ids)}}},
+        {'$group': {'_id': '$course_id', 'count': {'$sum': 1}}}
+    ])
+    return {item['_id']: item['count'] for item in counts}
+
+def compute_courses_progress(user_id, course_ids):
+    # Progress for many courses from two queries, whatever the number of courses
+    course_ids = list(course_ids)
+    lesson_counts = count_lessons_by_course(course_ids)
+    progress_items = progress_collection.find(
+        {'user_id': user_id, 'course_id': {'$in': course_ids}},
+        {'course_id': 1, 'lesson_id': 1, 'progress': 1, 'completed': 1}
+    )
     
-    completed_lessons = []
-    total_progress = 0
+    totals = {course_id: 0 for course_id in course_ids}
+    completed = {course_id: [] for course_id in course_ids}
     
     for item in progress_items:
         if item.get('completed', False):
-            completed_lessons.append(item['lesson_id'])
-        total_progress += item.get('progress', 0)
+            completed[item['course_id']].append(item['lesson_id'])
+        totals[item['course_id']] += item.get('progress', 0)
     
-    avg_progress = total_progress / total_lessons
+    progress = {}
+    for course_id in course_ids:
+        total_lessons = lesson_counts.get(course_id, 0)
+        if total_lessons == 0:
+            progress[course_id] = {'progress': 0, 'completedLessons': []}
+        else:
+            progress[course_id] = {
+                'progress': totals[course_id] / total_lessons,
+                'completedLessons': completed[course_id]
+            }
     
-    return jsonify({
-        'progress': avg_progress,
-        'completedLessons': completed_lessons
-    })
+    return progress
+
+@app.route('/api/progress/<course_id>', methods=['GET'])
+@token_required
+def get_course_progress(current_user, course_id):
+    progress = compute_courses_progress(str(current_user['_id']), [course_id])
+    return jsonify(progress[course_id])
 
 @app.route('/api/progress/<course_id>/<lesson_id>', methods=['GET', 'POST'])
 @token_required
 def lesson_progress(current_user, course_id, lesson_id):
+    key = progress_key(current_user['_id'], course_id, lesson_id)
+    
     if request.method == 'GET':
         progress = progress_collection.find_one({
             'user_id': str(current_user['_id']),
@@ -347,39 +1866,36 @@ def lesson_progress(current_user, course_id, lesson_id):
             'lesson_id': lesson_id
         })
         
+        # Heartbeats that have not been flushed yet are newer than the stored document
+        pending = progress_buffer.get(key)
+        if pending:
+            progress = dict(progress or {'completed': False}, **pending)
+        
         if not progress:
             return jsonify({'progress': 0, 'completed': False})
             
-        progress['_id'] = str(progress['_id'])
         return jsonify(progress)
         
     elif request.method == 'POST':
         data = request.get_json()
         
-        progress_collection.update_one(
-            {
-                'user_id': str(current_user['_id']),
-                'course_id': course_id,
-                'lesson_id': lesson_id
-            },
-            {
-                '$set': {
-                    'progress': data.get('progress', 0),
-                    'video_progress': data.get('video_progress'),
-                    'updated_at': datetime.utcnow()
-                }
-            },
-            upsert=True
-        )
+        progress_buffer.add(key, {
+            'progress': data.get('progress', 0),
+            'video_progress': data.get('video_progress'),
+            'updated_at': datetime.utcnow()
+        })
         
         return jsonify({'message': 'Progress updated'})
 
 @app.route('/api/progress/<course_id>/<lesson_id>/complete', methods=['POST'])
 @token_required
 def complete_lesson(current_user, course_id, lesson_id):
-    lesson = lessons_collection.find_one({'_id': ObjectId(lesson_id)})
-    if not lesson:
+    lesson = lessons_collection.find_one({'_id': ObjectId(lesson_id)}, {'course_id': 1, 'duration': 1})
+    # The course id ends up in the ledger entry for good, so it has to be the lesson's own
+    if not lesson or lesson['course_id'] != course_id:
         return jsonify({'error': 'Lesson not found'}), 404
+    
+    progress_buffer.discard([progress_key(current_user['_id'], course_id, lesson_id)])
         
     # Update progress
     progress_collection.update_one(
@@ -398,31 +1914,105 @@ def complete_lesson(current_user, course_id, lesson_id):
         upsert=True
     )
     
-    # Add points
-    points = lesson.get('duration', 0) * 2
-    users_collection.update_one(
-        {'_id': current_user['_id']},
-        {'$inc': {'points': points}}
-    )
+    # Add points, only the first time this lesson is completed
+    points = award_points(current_user['_id'], course_id, lesson_id, lesson.get('duration', 0) * 2, 'lesson')
     
     return jsonify({'message': 'Lesson marked as completed', 'points': points})
 
+PROGRESS_BATCH_MAX_EVENTS = int(os.environ.get('PROGRESS_BATCH_MAX_EVENTS', 500))
+
+@app.route('/api/progress/batch', methods=['POST'])
+@token_required
+def sync_progress_batch(current_user):
+    data = request.get_json()
+    events = data.get('events') if data else None
+    
+    if not isinstance(events, list) or not events:
+        return jsonify({'error': 'events must be a non-empty list'}), 400
+    if len(events) > PROGRESS_BATCH_MAX_EVENTS:
+        return jsonify({'error': f"At most {PROGRESS_BATCH_MAX_EVENTS} events per batch"}), 400
+    
+    user_id = str(current_user['_id'])
+    rejected = []
+    lesson_ids = set()
+    
+    for i, event in enumerate(events):
+        if not isinstance(event, dict) or not event.get('course_id') or not event.get('lesson_id'):
+            rejected.append({'index': i, 'error': 'Missing course_id or lesson_id'})
+            continue
+        try:
+            lesson_ids.add(ObjectId(event['lesson_id']))
+        except (InvalidId, TypeError):
+            rejected.append({'index': i, 'error': 'Invalid lesson_id'})
+            
+    # Validate every event against its lesson with a single query
+    lessons = {
+        str(lesson['_id']): lesson
+        for lesson in lessons_collection.find({'_id': {'$in': list(lesson_ids)}}, {'course_id': 1, 'duration': 1})
+    }
+    
+    # Later events for the same lesson win, but a completion is never undone
+    updates = {}
+    completed = {}
+    rejected_indexes = {item['index'] for item in rejected}
+    now = datetime.utcnow()
+    
+    for i, event in enumerate(events):
+        if i in rejected_indexes:
+            continue
+        lesson = lessons.get(event['lesson_id'])
+        if not lesson or lesson['course_id'] != event['course_id']:
+            rejected.append({'index': i, 'error': 'Lesson not found'})
+            continue
+            
+        key = progress_key(user_id, event['course_id'], event['lesson_id'])
+        if event.get('completed'):
+            completed[key] = lesson
+            updates[key] = {'progress': 1, 'completed': True, 'updated_at': now}
+        elif key not in completed:
+            fields = {'progress': event.get('progress', 0), 'updated_at': now}
+            if 'video_progress' in event:
+                fields['video_progress'] = event['video_progress']
+            updates[key] = fields
+            
+    if updates:
+        progress_buffer.discard(updates.keys())
+        progress_collection.bulk_write([
+            UpdateOne(
+                {'user_id': user_id, 'course_id': course_id, 'lesson_id': lesson_id},
+                {'$set': fields},
+                upsert=True
+            )
+            for (_, course_id, lesson_id), fields in updates.items()
+        ], ordered=False)
+    
+    # Add points for all first-time completions at once
+    points = award_points_batch(user_id, [
+        (course_id, lesson_id, lesson.get('duration', 0) * 2, 'lesson')
+        for (_, course_id, lesson_id), lesson in completed.items()
+    ])
+    
+    return jsonify({
+        'applied': len(updates),
+        'rejected': sorted(rejected, key=lambda item: item['index']),
+        'points': points
+    })
+
 # User Dashboard Routes
 @app.route('/api/users/dashboard', methods=['GET'])
 @token_required
 def user_dashboard(current_user):
     # Get enrolled courses
-    enrollments = list(enrollments_collection.find({'user_id': str(current_user['_id'])}))
+    enrollments = list(enrollments_collection.find({'user_id': str(current_user['_id'])}, {'course_id': 1}))
     course_ids = [e['course_id'] for e in enrollments]
     
-    courses = list(courses_collection.find({'_id': {'$in': [ObjectId(id) for id in course_ids]}}))
-    for course in courses:
-        course['_id'] = str(course['_id'])
-        
-    # Get progress for each course
-    progress = {}
-    for course_id in course_ids:
-        progress[course_id] = get_course_progress(current_user, course_id).json
+    courses = list(courses_collection.find(
+        {'_id': {'$in': [ObjectId(id) for id in course_ids]}},
+        projection_arg(COURSE_CARD_PROJECTION)
+    ))
+    
+    # Get progress for all courses at once
+    progress = compute_courses_progress(str(current_user['_id']), course_ids)
     
     return jsonify({
         'courses': courses,
@@ -432,46 +2022,41 @@ def user_dashboard(current_user):
 @app.route('/api/users/courses', methods=['GET'])
 @token_required
 def user_courses(current_user):
-    enrollments = list(enrollments_collection.find({'user_id': str(current_user['_id'])}))
+    enrollments = list(enrollments_collection.find({'user_id': str(current_user['_id'])}, {'course_id': 1}))
     course_ids = [e['course_id'] for e in enrollments]
     
-    courses = list(courses_collection.find({'_id': {'$in': [ObjectId(id) for id in course_ids]}}))
-    for course in courses:
-        course['_id'] = str(course['_id'])
-        
-    return jsonify(courses)
+    courses = courses_collection.find(
+        {'_id': {'$in': [ObjectId(id) for id in course_ids]}},
+        projection_arg(COURSE_CARD_PROJECTION)
+    )
+    return stream_json_array(courses)
 
 @app.route('/api/users/progress', methods=['GET'])
 @token_required
 def user_progress(current_user):
-    progress = list(progress_collection.find({'user_id': str(current_user['_id'])}))
-    for p in progress:
-        p['_id'] = str(p['_id'])
-    return jsonify(progress)
+    return paginate(progress_collection, {'user_id': str(current_user['_id'])}, projection=projection_arg())
 
 @app.route('/api/users/stats', methods=['GET'])
 @token_required
 def user_stats(current_user):
+    user_id = str(current_user['_id'])
+    
     # Count enrolled courses
-    enrolled_courses = enrollments_collection.count_documents({'user_id': str(current_user['_id'])})
+    course_ids = enrollments_collection.distinct('course_id', {'user_id': user_id})
+    enrolled_courses = len(course_ids)
     
-    # Count completed courses
-    completed_courses = 0
-    enrollments = list(enrollments_collection.find({'user_id': str(current_user['_id'])}))
+    # Count completed courses from grouped counts instead of per-course queries
+    completed_counts = progress_collection.aggregate([
+        {'$match': {'user_id': user_id, 'course_id': {'$in': course_ids}, 'completed': True}},
+        {'$group': {'_id': '$course_id', 'count': {'$sum': 1}}}
+    ])
+    completed_counts = {item['_id']: item['count'] for item in completed_counts}
+    lesson_counts = count_lessons_by_course(course_ids)
     
-    for enrollment in enrollments:
-        # Get progress from the progress collection directly
-        progress_items = list(progress_collection.find({
-            'user_id': str(current_user['_id']),
-            'course_id': enrollment['course_id'],
-            'completed': True
-        }))
-        
-        lessons_count = lessons_collection.count_documents({
-            'course_id': enrollment['course_id']
-        })
-        
-        if lessons_count > 0 and len(progress_items) == lessons_count:
+    completed_courses = 0
+    for course_id in course_ids:
+        lessons_count = lesson_counts.get(course_id, 0)
+        if lessons_count > 0 and completed_counts.get(course_id, 0) == lessons_count:
             completed_courses += 1
     
     return jsonify({
@@ -481,6 +2066,44 @@ def user_stats(current_user):
         'points': current_user.get('points', 0)
     })
 
+# Leaderboard Routes
+@app.route('/api/leaderboard', methods=['GET'])
+@token_required
+def leaderboard(current_user):
+    course_id = request.args.get('course_id')
+    limit = max(1, min(request.args.get('limit', 10, type=int), MAX_PAGE_SIZE))
+    offset = max(0, request.args.get('offset', 0, type=int))
+    
+    board = get_leaderboard(course_id)
+    entries = board.top(limit, offset)
+    
+    # Names are the only thing the board itself does not hold
+    users = users_collection.find(
+        {'_id': {'$in': [ObjectId(entry['user_id']) for entry in entries]}},
+        {'username': 1}
+    )
+    usernames = {str(user['_id']): user.get('username') for user in users}
+    
+    for entry in entries:
+        entry['username'] = usernames.get(entry['user_id'])
+        entry['rank'] = board.rank(entry['user_id'])
+    
+    return jsonify({'total': len(board), 'entries': entries})
+
+@app.route('/api/users/rank', methods=['GET'])
+@token_required
+def user_rank(current_user):
+    board = get_leaderboard(request.args.get('course_id'))
+    user_id = str(current_user['_id'])
+    points, streak = board.score(user_id)
+    
+    return jsonify({
+        'rank': board.rank(user_id),
+        'points': points,
+        'streak': streak,
+        'total': len(board)
+    })
+
 # Bookmark Routes
 @app.route('/api/bookmarks/<lesson_id>/check', methods=['GET'])
 @token_required
@@ -488,7 +2111,7 @@ def check_bookmark(current_user, lesson_id):
     bookmark = bookmarks_collection.find_one({
         'user_id': str(current_user['_id']),
         'lesson_id': lesson_id
-    })
+    }, {'_id': 1})
     
     return jsonify({'isBookmarked': bool(bookmark)})
 
@@ -502,7 +2125,7 @@ def add_bookmark(current_user):
         return jsonify({'error': 'Lesson ID is required'}), 400
         
     # Check if lesson exists
-    lesson = lessons_collection.find_one({'_id': ObjectId(lesson_id)})
+    lesson = lessons_collection.find_one({'_id': ObjectId(lesson_id)}, {'_id': 1})
     if not lesson:
         return jsonify({'error': 'Lesson not found'}), 404
         
@@ -510,7 +2133,7 @@ def add_bookmark(current_user):
     existing = bookmarks_collection.find_one({
         'user_id': str(current_user['_id']),
         'lesson_id': lesson_id
-    })
+    }, {'_id': 1})
     
     if existing:
         return jsonify({'error': 'Already bookmarked'}), 400
@@ -537,35 +2160,58 @@ def remove_bookmark(current_user, lesson_id):
         
     return jsonify({'message': 'Bookmark removed'})
 
+# Media Routes
+@app.route(MEDIA_PATH + '<filename>', methods=['GET'])
+def serve_media(filename):
+    # ?w=320 serves the smallest WebP variant at least that wide, once it exists
+    width = request.args.get('w', type=int)
+    exact = not width
+    if width and 'image/webp' in request.accept_mimetypes:
+        digest = filename.rsplit('.', 1)[0]
+        for variant_width in THUMBNAIL_WIDTHS:
+            if variant_width >= width and os.path.exists(os.path.join(MEDIA_ROOT, variant_name(digest, variant_width))):
+                filename = variant_name(digest, variant_width)
+                exact = True
+                break
+    
+    # Only the file the URL names can be cached forever; a fallback original
+    # must not stick to the ?w= URL once its variant has been generated
+    max_age = MEDIA_MAX_AGE if exact else MEDIA_FALLBACK_MAX_AGE
+    # conditional=True also answers Range requests with 206
+    response = send_from_directory(MEDIA_ROOT, filename, conditional=True, max_age=max_age)
+    response.headers['Cache-Control'] = f"public, max-age={max_age}" + (', immutable' if exact else '')
+    response.headers['Vary'] = 'Accept'
+    return response
+
 # Admin Routes
 @app.route('/api/admin/stats', methods=['GET'])
 @token_required
 @admin_required
 def admin_stats(current_user):
-    total_courses = courses_collection.count_documents({})
-    total_users = users_collection.count_documents({})
-    total_lessons = lessons_collection.count_documents({})
-    
-    # Calculate revenue (simplified)
-    premium_enrollments = enrollments_collection.count_documents({'is_premium': True})
-    revenue = premium_enrollments * 19.99  # Assuming $19.99 per premium enrollment
+    stats = admin_stats_cache.get(METRICS_ID)
+    if stats is None:
+        metrics = load_metrics()
+        
+        # Calculate revenue (simplified)
+        revenue = metrics.get('premium_enrollments', 0) * PREMIUM_ENROLLMENT_PRICE
+        
+        stats = {
+            'totalCourses': metrics.get('courses', 0),
+            'totalUsers': metrics.get('users', 0),
+            'totalLessons': metrics.get('lessons', 0),
+            'totalEnrollments': metrics.get('enrollments', 0),
+            'revenue': revenue
+        }
+        admin_stats_cache.set(METRICS_ID, stats)
     
-    return jsonify({
-        'totalCourses': total_courses,
-        'totalUsers': total_users,
-        'totalLessons': total_lessons,
-        'revenue': revenue
-    })
+    return jsonify(stats)
 
 @app.route('/api/admin/courses', methods=['GET', 'POST'])
 @token_required
 @admin_required
 def admin_courses(current_user):
     if request.method == 'GET':
-        courses = list(courses_collection.find())
-        for course in courses:
-            course['_id'] = str(course['_id'])
-        return jsonify(courses)
+        return paginate(courses_collection, {}, projection=projection_arg())
         
     elif request.method == 'POST':
         data = request.form.to_dict()
@@ -574,10 +2220,10 @@ def admin_courses(current_user):
         # Handle thumbnail upload
         thumbnail_url = None
         if 'thumbnail' in files:
-            thumbnail = files['thumbnail']
-            filename = f"course_{datetime.now().timestamp()}.{thumbnail.filename.split('.')[-1]}"
-            thumbnail.save(filename)
-            thumbnail_url = filename
+            try:
+                thumbnail_url = store_upload(files['thumbnail'])
+            except UnsupportedMedia:
+                return jsonify({'error': 'Unsupported thumbnail type'}), 400
         
         course = {
             'title': data.get('title'),
@@ -590,8 +2236,9 @@ def admin_courses(current_user):
             'updated_at': datetime.utcnow()
         }
         
-        course_id = courses_collection.insert_one(course).inserted_id
-        course['_id'] = str(course_id)
+        courses_collection.insert_one(course)
+        bump_metrics(courses=1)
+        invalidate_content()
         
         return jsonify(course), 201
 
@@ -600,8 +2247,6 @@ def admin_courses(current_user):
 @admin_required
 def admin_recent_courses(current_user):
     courses = list(courses_collection.find().sort('created_at', -1).limit(5))
-    for course in courses:
-        course['_id'] = str(course['_id'])
     return jsonify(courses)
 
 @app.route('/api/admin/courses/<course_id>', methods=['GET', 'PUT', 'DELETE'])
@@ -613,7 +2258,6 @@ def admin_course(current_user, course_id):
         if not course:
             return jsonify({'error': 'Course not found'}), 404
             
-        course['_id'] = str(course['_id'])
         return jsonify(course)
         
     elif request.method == 'PUT':
@@ -631,10 +2275,10 @@ def admin_course(current_user, course_id):
         
         # Handle thumbnail upload
         if 'thumbnail' in files:
-            thumbnail = files['thumbnail']
-            filename = f"course_{datetime.now().timestamp()}.{thumbnail.filename.split('.')[-1]}"
-            thumbnail.save(filename)
-            updates['thumbnail'] = filename
+            try:
+                updates['thumbnail'] = store_upload(files['thumbnail'])
+            except UnsupportedMedia:
+                return jsonify({'error': 'Unsupported thumbnail type'}), 400
         
         result = courses_collection.update_one(
             {'_id': ObjectId(course_id)},
@@ -643,49 +2287,57 @@ def admin_course(current_user, course_id):
         
         if result.modified_count == 0:
             return jsonify({'error': 'No changes made'}), 400
-            
+        
+        invalidate_content(course_id=course_id)
         return jsonify({'message': 'Course updated'})
         
     elif request.method == 'DELETE':
-        # Delete associated lessons first
-        lessons_collection.delete_many({'course_id': course_id})
-        
-        # Delete course
+        # Delete course; its lessons, progress, enrollments and bookmarks are
+        # removed by a background job
         result = courses_collection.delete_one({'_id': ObjectId(course_id)})
         
         if result.deleted_count == 0:
             return jsonify({'error': 'Course not found'}), 404
+        
+        bump_metrics(courses=-1)
+        invalidate_content(course_id=course_id)
+        job_id = start_course_deletion(course_id)
             
-        return jsonify({'message': 'Course deleted'})
+        return jsonify({'message': 'Course deleted', 'job_id': str(job_id)}), 202
+
+def new_lesson(course_id, data):
+    return {
+        'course_id': course_id,
+        'title': data.get('title'),
+        'description': data.get('description'),
+        'lesson_type': data.get('lesson_type', 'text'),
+        'content': data.get('content', {}),
+        'duration': int(data.get('duration', 0)),
+        'is_free': data.get('is_free', True),
+        'order': int(data.get('order', 0)),
+        'created_at': datetime.utcnow(),
+        'updated_at': datetime.utcnow()
+    }
 
 @app.route('/api/admin/courses/<course_id>/lessons', methods=['GET', 'POST'])
 @token_required
 @admin_required
 def admin_lessons(current_user, course_id):
     if request.method == 'GET':
-        lessons = list(lessons_collection.find({'course_id': course_id}).sort('order', 1))
-        for lesson in lessons:
-            lesson['_id'] = str(lesson['_id'])
-        return jsonify(lessons)
+        return paginate(
+            lessons_collection,
+            {'course_id': course_id},
+            sort_fields=('order', '_id'),
+            projection=projection_arg(LESSON_OUTLINE_PROJECTION)
+        )
         
     elif request.method == 'POST':
         data = request.get_json()
-        
-        lesson = {
-            'course_id': course_id,
-            'title': data.get('title'),
-            'description': data.get('description'),
-            'lesson_type': data.get('lesson_type', 'text'),
-            'content': data.get('content', {}),
-            'duration': int(data.get('duration', 0)),
-            'is_free': data.get('is_free', True),
-            'order': int(data.get('order', 0)),
-            'created_at': datetime.utcnow(),
-            'updated_at': datetime.utcnow()
-        }
+        lesson = new_lesson(course_id, data)
         
         # Insert new lesson
         lesson_id = lessons_collection.insert_one(lesson).inserted_id
+        bump_metrics(lessons=1)
         lesson['_id'] = str(lesson_id)
         
         # Add lesson _id to course's lessons array
@@ -693,9 +2345,159 @@ def admin_lessons(current_user, course_id):
             {'_id': ObjectId(course_id)},
             {'$push': {'lesson': lesson['_id']}}  # Add to lessons array
         )
+        invalidate_content(course_id=course_id)
         
         return jsonify(lesson), 201
 
+# Bulk content import/export
+IMPORT_CHUNK_SIZE = int(os.environ.get('IMPORT_CHUNK_SIZE', 500))
+IMPORT_MAX_ERRORS = 100
+
+def import_course(record):
+    if not record.get('title'):
+        raise ValueError('Course title is required')
+    return {
+        '_id': ObjectId(),
+        'title': record['title'],
+        'description': record.get('description'),
+        'category': record.get('category', 'Language'),
+        'difficulty': record.get('difficulty', 'Beginner'),
+        'is_published': bool(record.get('is_published', False)),
+        'is_featured': bool(record.get('is_featured', False)),
+        'thumbnail': record.get('thumbnail'),
+        'lesson': [],
+        'created_at': datetime.utcnow(),
+        'updated_at': datetime.utcnow()
+    }
+
+def import_lesson(course_id, record):
+    if not record.get('title'):
+        raise ValueError('Lesson title is required')
+    lesson = new_lesson(course_id, record)
+    lesson['_id'] = ObjectId()
+    if 'is_published' in record:
+        lesson['is_published'] = bool(record['is_published'])
+    return lesson
+
+class ContentImport:
+    # Buffers parsed records and writes them in chunks. Course ids are generated
+    # up front so lessons can point at a course that has not been written yet.
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.courses = []
+        self.lessons = []
+        self.course_lessons = {}
+        self.touched_courses = set()
+        self.imported_courses = 0
+        self.imported_lessons = 0
+        
+    def add_course(self, course):
+        self.courses.append(course)
+        self.maybe_flush()
+        
+    def add_lesson(self, lesson):
+        self.lessons.append(lesson)
+        self.course_lessons.setdefault(lesson['course_id'], []).append(str(lesson['_id']))
+        self.touched_courses.add(lesson['course_id'])
+        self.maybe_flush()
+        
+    def maybe_flush(self):
+        if len(self.courses) + len(self.lessons) >= self.chunk_size:
+            self.flush()
+            
+    def flush(self):
+        # Courses go first so a lesson's course always exists once the lesson does
+        if self.courses:
+            courses_collection.insert_many(self.courses, ordered=False)
+            self.imported_courses += len(self.courses)
+        if self.lessons:
+            lessons_collection.insert_many(self.lessons, ordered=False)
+            self.imported_lessons += len(self.lessons)
+        if self.course_lessons:
+            courses_collection.bulk_write([
+                UpdateOne({'_id': ObjectId(course_id)}, {'$push': {'lesson': {'$each': lesson_ids}}})
+                for course_id, lesson_ids in self.course_lessons.items()
+            ], ordered=False)
+            
+        bump_metrics(courses=len(self.courses), lessons=len(self.lessons))
+        self.courses, self.lessons, self.course_lessons = [], [], {}
+
+@app.route('/api/admin/courses/import', methods=['POST'])
+@token_required
+@admin_required
+def admin_import_courses(current_user):
+    # NDJSON: a {"type": "course", ...} line followed by the {"type": "lesson", ...}
+    # lines that belong to it. A lesson line may instead name an existing course_id.
+    batch = ContentImport(IMPORT_CHUNK_SIZE)
+    errors = []
+    current_course_id = None
+    existing_courses = {}
+    
+    for line_number, line in enumerate(request.stream, 1):
+        if not line.strip():
+            continue
+        try:
+            record = app.json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('Each line must be a JSON object')
+                
+            if record.get('type') == 'course':
+                current_course_id = None
+                course = import_course(record)
+                batch.add_course(course)
+                current_course_id = str(course['_id'])
+                
+            elif record.get('type') == 'lesson':
+                course_id = record.get('course_id')
+                if course_id:
+                    if course_id not in existing_courses:
+                        existing_courses[course_id] = courses_collection.find_one({'_id': ObjectId(course_id)}, {'_id': 1}) is not None
+                    if not existing_courses[course_id]:
+                        raise ValueError(f"Course {course_id} not found")
+                else:
+                    course_id = current_course_id
+                    if not course_id:
+                        raise ValueError('Lesson has no valid course before it')
+                batch.add_lesson(import_lesson(course_id, record))
+                
+            else:
+                raise ValueError('type must be "course" or "lesson"')
+        except (ValueError, TypeError, InvalidId) as e:
+            if len(errors) < IMPORT_MAX_ERRORS:
+                errors.append({'line': line_number, 'error': str(e)})
+                
+    batch.flush()
+    
+    invalidate_content()
+    for course_id in batch.touched_courses:
+        invalidate_content(course_id=course_id)
+    
+    return jsonify({
+        'importedCourses': batch.imported_courses,
+        'importedLessons': batch.imported_lessons,
+        'errors': errors
+    }), 201
+
+@app.route('/api/admin/courses/<course_id>/export', methods=['GET'])
+@token_required
+@admin_required
+def admin_export_course(current_user, course_id):
+    course = courses_collection.find_one({'_id': ObjectId(course_id)}, {'lesson': 0})
+    if not course:
+        return jsonify({'error': 'Course not found'}), 404
+        
+    lessons = lessons_collection.find({'course_id': course_id}, {'course_id': 0}).sort('order', 1)
+    
+    # The same line format admin_import_courses reads, streamed a lesson at a time
+    def generate():
+        yield app.json.dumps(dict(course, type='course')) + '\n'
+        for lesson in lessons:
+            yield app.json.dumps(dict(lesson, type='lesson')) + '\n'
+            
+    response = app.response_class(generate(), mimetype='application/x-ndjson')
+    response.headers['Content-Disposition'] = f"attachment; filename=course_{course_id}.ndjson"
+    return response
+
 @app.route('/api/admin/lessons/<lesson_id>', methods=['GET', 'PUT', 'DELETE'])
 @token_required
 @admin_required
@@ -705,7 +2507,6 @@ def admin_lesson(current_user, lesson_id):
         if not lesson:
             return jsonify({'error': 'Lesson not found'}), 404
             
-        lesson['_id'] = str(lesson['_id'])
         return jsonify(lesson)
         
     elif request.method == 'PUT':
@@ -722,33 +2523,75 @@ def admin_lesson(current_user, lesson_id):
             'updated_at': datetime.utcnow()
         }
         
-        result = lessons_collection.update_one(
+        result = lessons_collection.find_one_and_update(
             {'_id': ObjectId(lesson_id)},
-            {'$set': updates}
+            {'$set': updates},
+            projection={'course_id': 1}
         )
         
-        if result.modified_count == 0:
+        if not result:
             return jsonify({'error': 'No changes made'}), 400
-            
+        
+        invalidate_content(course_id=result['course_id'], lesson_id=lesson_id)
         return jsonify({'message': 'Lesson updated'})
         
     elif request.method == 'DELETE':
-        result = lessons_collection.delete_one({'_id': ObjectId(lesson_id)})
+        lesson = lessons_collection.find_one_and_delete(
+            {'_id': ObjectId(lesson_id)},
+            projection={'course_id': 1}
+        )
         
-        if result.deleted_count == 0:
+        if not lesson:
             return jsonify({'error': 'Lesson not found'}), 404
-            
+        
+        bump_metrics(lessons=-1)
+        invalidate_content(course_id=lesson['course_id'], lesson_id=lesson_id)
         return jsonify({'message': 'Lesson deleted'})
 
+@app.route('/api/admin/lessons/<lesson_id>/grade', methods=['POST'])
+@token_required
+@admin_required
+def admin_grade_quiz(current_user, lesson_id):
+    data = request.get_json()
+    submissions = data.get('submissions') if data else None
+    
+    if not isinstance(submissions, list):
+        return jsonify({'error': 'submissions must be a list'}), 400
+        
+    answer_key = load_answer_key(lesson_id)
+    if not answer_key:
+        return jsonify({'error': 'Quiz not found'}), 404
+        
+    return jsonify(grade_quiz_batch(answer_key, submissions))
+
+@app.route('/api/admin/runtime', methods=['GET'])
+@token_required
+@admin_required
+def admin_runtime(current_user):
+    return jsonify({
+        'userCache': user_cache.stats(),
+        'contentCache': content_cache.stats(),
+        'progressBuffer': progress_buffer.stats(),
+        'assistantGenerations': generation_tracker.stats(),
+        'messageBuffer': message_buffer.stats(),
+        'kdfPool': kdf_pool.stats()
+    })
+
+@app.route('/api/admin/jobs/<job_id>', methods=['GET'])
+@token_required
+@admin_required
+def admin_job(current_user, job_id):
+    job = jobs_collection.find_one({'_id': ObjectId(job_id)})
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+        
+    return jsonify(job)
+
 @app.route('/api/admin/users/recent', methods=['GET'])
 @token_required
 @admin_required
 def admin_recent_users(current_user):
-    users = list(users_collection.find().sort('created_at', -1).limit(5))
-    for user in users:
-        user['_id'] = str(user['_id'])
-        if 'password' in user:
-            del user['password']
+    users = list(users_collection.find({}, USER_PROJECTION).sort('created_at', -1).limit(5))
     return jsonify(users)
 
 # Assistant Routes
@@ -757,29 +2600,258 @@ def admin_recent_users(current_user):
 def start_assistant_session(current_user):
     data = request.get_json()
     course_id = data.get('course_id')
+    user_id = str(current_user['_id'])
+    now = datetime.utcnow()
     
-    session_id = str(uuid.uuid4())
+    if data.get('new'):
+        session_id = str(uuid.uuid4())
+        sessions_collection.insert_one({
+            'session_id': session_id,
+            'user_id': user_id,
+            'course_id': course_id,
+            'created_at': now,
+            'last_active_at': now,
+            'active': True
+        })
+        return jsonify({'session_id': session_id, 'messages': [], 'has_more': False, 'before': None})
     
-    sessions_collection.insert_one({
-        'session_id': session_id,
-        'user_id': str(current_user['_id']),
-        'course_id': course_id,
-        'created_at': datetime.utcnow(),
-        'active': True
-    })
+    # Resume the latest conversation for this course, or start one, in one round trip
+    session = sessions_collection.find_one_and_update(
+        {'user_id': user_id, 'course_id': course_id},
+        {
+            '$set': {'active': True, 'last_active_at': now},
+            '$setOnInsert': {'session_id': str(uuid.uuid4()), 'created_at': now}
+        },
+        sort=[('last_active_at', DESCENDING)],
+        projection={'session_id': 1},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
     
-    # Load previous messages if any
-    messages = list(messages_collection.find({
-        'session_id': session_id
-    }).sort('timestamp', 1))
+    history = message_window(session['session_id'], request.args.get('limit', type=int))
+    return jsonify(dict(history, session_id=session['session_id']))
+
+# Assistant history
+def owns_session(user_id, session_id):
+    return sessions_collection.find_one({'session_id': session_id, 'user_id': str(user_id)}, {'_id': 1}) is not None
+
+HISTORY_WINDOW = int(os.environ.get('ASSISTANT_HISTORY_WINDOW', 50))
+
+def message_window(session_id, limit=None, before=None):
+    # The newest `limit` messages older than `before`, returned oldest first and
+    # read backwards along the (session_id, timestamp, _id) index
+    limit = max(1, min(limit or HISTORY_WINDOW, MAX_PAGE_SIZE))
+    query = {'session_id': session_id}
+    if before:
+        timestamp, message_id = before
+        query['$or'] = [
+            {'timestamp': {'$lt': timestamp}},
+            {'timestamp': timestamp, '_id': {'$lt': message_id}}
+        ]
+        
+    message_buffer.flush()
+    messages = list(messages_collection.find(query).sort([
+        ('timestamp', DESCENDING), ('_id', DESCENDING)
+    ]).limit(limit + 1))
     
-    for message in messages:
-        message['_id'] = str(message['_id'])
+    # Older messages may already have been moved into archives
+    if len(messages) <= limit:
+        oldest = (messages[-1]['timestamp'], messages[-1]['_id']) if messages else before
+        messages += archived_messages(session_id, limit + 1 - len(messages), oldest)
     
-    return jsonify({
-        'session_id': session_id,
-        'messages': messages
-    })
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    messages.reverse()
+    
+    return {
+        'messages': messages,
+        'has_more': has_more,
+        'before': encode_cursor(messages[0], ['timestamp', '_id']) if has_more else None
+    }
+
+def archived_messages(session_id, limit, before=None):
+    # Newest first, like the hot query; archives of a session never overlap in time
+    query = {'session_id': session_id}
+    if before:
+        query['from'] = {'$lte': before[0]}
+        
+    messages = []
+    for archive in message_archives_collection.find(query).sort('to', DESCENDING):
+        for message in reversed(archive['messages']):
+            if before and (message['timestamp'], message['_id']) >= before:
+                continue
+            messages.append(dict(message, session_id=session_id))
+        if len(messages) >= limit:
+            break
+    return messages[:limit]
+
+def decode_message_cursor(cursor):
+    timestamp, message_id = decode_cursor(cursor, ['timestamp', '_id'])
+    try:
+        # Stored timestamps come back naive UTC; keep the cursor comparable with them
+        timestamp = datetime.fromisoformat(timestamp).astimezone(timezone.utc).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    return timestamp, message_id
+
+@app.route('/api/assistant/sessions/<session_id>/messages', methods=['GET'])
+@token_required
+def assistant_history(current_user, session_id):
+    if not owns_session(current_user['_id'], session_id):
+        return jsonify({'error': 'Session not found'}), 404
+        
+    before = None
+    if request.args.get('before'):
+        try:
+            before = decode_message_cursor(request.args['before'])
+        except InvalidCursor:
+            return jsonify({'error': 'Invalid cursor'}), 400
+    
+    history = message_window(session_id, request.args.get('limit', type=int), before)
+    return jsonify(dict(history, session_id=session_id))
+
+# Assistant generation
+class EchoAssistantBackend:
+    # Deterministic local stand-in for a model: streams the echo reply one word
+    # at a time. ASSISTANT_CHUNK_DELAY simulates token latency.
+    def __init__(self, delay=0):
+        self.delay = delay
+        
+    def generate(self, session_id, message):
+        for i, word in enumerate(f"I received your message: {message}".split(' ')):
+            if self.delay:
+                socketio.sleep(self.delay)
+            yield word if i == 0 else ' ' + word
+
+ASSISTANT_BACKENDS = {
+    'echo': lambda: EchoAssistantBackend(delay=float(os.environ.get('ASSISTANT_CHUNK_DELAY', 0)))
+}
+
+def create_assistant_backend():
+    # ASSISTANT_BACKEND is a registered name or "package.module:factory"; the
+    # factory returns an object whose generate(session_id, message) yields text chunks
+    name = os.environ.get('ASSISTANT_BACKEND', 'echo')
+    if name in ASSISTANT_BACKENDS:
+        return ASSISTANT_BACKENDS[name]()
+    module_name, _, factory = name.partition(':')
+    return getattr(importlib.import_module(module_name), factory)()
+
+assistant_backend = create_assistant_backend()
+
+class GenerationTracker:
+    # Generations are claimed on the session document, so the per-session limit
+    # and cancellation hold across nodes. Each node keeps an event per
+    # generation it runs and polls the session for cancel flags between chunks.
+    def __init__(self, max_per_session=1, timeout=300, poll_interval=0.5):
+        self.max_per_session = max_per_session
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._running = {}
+        self._lock = threading.Lock()
+        
+    def start(self, session_id):
+        now = datetime.utcnow()
+        # Claims left behind by a node that died mid-reply stop counting after timeout
+        sessions_collection.update_one(
+            {'session_id': session_id},
+            {'$pull': {'generations': {'started_at': {'$lt': now - timedelta(seconds=self.timeout)}}}}
+        )
+        message_id = str(uuid.uuid4())
+        result = sessions_collection.update_one(
+            {'session_id': session_id, f"generations.{self.max_per_session - 1}": {'$exists': False}},
+            {'$push': {'generations': {'message_id': message_id, 'started_at': now, 'cancelled': False}}}
+        )
+        if not result.modified_count:
+            return None, None
+        with self._lock:
+            event = self._running.setdefault(session_id, {})[message_id] = threading.Event()
+        return message_id, event
+        
+    def cancel(self, session_id, message_id=None):
+        match = {'message_id': message_id} if message_id else {'cancelled': False}
+        session = sessions_collection.find_one_and_update(
+            {'session_id': session_id, 'generations': {'$elemMatch': match}},
+            {'$set': {'generations.$[g].cancelled': True}},
+            array_filters=[{f"g.{field}": value for field, value in match.items()}],
+            projection={'generations': 1}
+        )
+        cancelled = [
+            generation for generation in (session or {}).get('generations', [])
+            if not generation['cancelled'] and (not message_id or generation['message_id'] == message_id)
+        ]
+        # Generations running here stop at once; other nodes see the flag on their next poll
+        with self._lock:
+            running = self._running.get(session_id, {})
+            events = [running[generation['message_id']] for generation in cancelled if generation['message_id'] in running]
+        for event in events:
+            event.set()
+        return len(cancelled)
+    
+    def poll(self, session_id, message_id, event):
+        if not event.is_set() and sessions_collection.find_one(
+            {'session_id': session_id, 'generations': {'$elemMatch': {'message_id': message_id, 'cancelled': True}}},
+            {'_id': 1}
+        ):
+            event.set()
+        return event.is_set()
+    
+    def finish(self, session_id, message_id):
+        sessions_collection.update_one({'session_id': session_id}, {'$pull': {'generations': {'message_id': message_id}}})
+        with self._lock:
+            running = self._running.get(session_id, {})
+            running.pop(message_id, None)
+            if not running:
+                self._running.pop(session_id, None)
+                
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._running), 'running': sum(len(running) for running in self._running.values())}
+
+generation_tracker = GenerationTracker(
+    max_per_session=int(os.environ.get('ASSISTANT_MAX_PER_SESSION', 1)),
+    timeout=int(os.environ.get('ASSISTANT_GENERATION_TIMEOUT', 300)),
+    poll_interval=float(os.environ.get('ASSISTANT_CANCEL_POLL_INTERVAL', 0.5))
+)
+
+def run_generation(session_id, message_id, message, cancelled):
+    # Runs off the request thread; chunks reach the room as soon as they exist
+    chunks = []
+    next_poll = time.monotonic() + generation_tracker.poll_interval
+    try:
+        socketio.emit('assistant_typing', {'session_id': session_id, 'message_id': message_id}, room=session_id)
+        for chunk in assistant_backend.generate(session_id, message):
+            if time.monotonic() >= next_poll:
+                # A cancel that reached another node only shows up on the session
+                generation_tracker.poll(session_id, message_id, cancelled)
+                next_poll = time.monotonic() + generation_tracker.poll_interval
+            if cancelled.is_set():
+                break
+            chunks.append(chunk)
+            socketio.emit('assistant_message_chunk', {
+                'session_id': session_id,
+                'message_id': message_id,
+                'index': len(chunks) - 1,
+                'delta': chunk
+            }, room=session_id)
+        
+        assistant_message = {
+            'session_id': session_id,
+            'message_id': message_id,
+            'sender': 'assistant',
+            'content': ''.join(chunks),
+            'cancelled': cancelled.is_set(),
+            'timestamp': datetime.utcnow()
+        }
+        
+        message_buffer.add(assistant_message)
+        
+        # The complete message still goes out for clients that ignore chunks
+        socketio.emit('assistant_message', assistant_message, room=session_id)
+    except Exception as e:
+        print(f"Assistant generation failed for session {session_id}: {e}")
+        socketio.emit('assistant_error', {'session_id': session_id, 'message_id': message_id}, room=session_id)
+    finally:
+        generation_tracker.finish(session_id, message_id)
 
 @app.route('/api/assistant/message', methods=['POST'])
 @token_required
@@ -790,6 +2862,13 @@ def send_assistant_message(current_user):
     
     if not session_id or not message:
         return jsonify({'error': 'Missing session_id or message'}), 400
+    
+    if not owns_session(current_user['_id'], session_id):
+        return jsonify({'error': 'Session not found'}), 404
+    
+    message_id, cancelled = generation_tracker.start(session_id)
+    if not message_id:
+        return jsonify({'error': 'A reply is already being generated for this session'}), 429
         
     # Save user message
     user_message = {
@@ -799,39 +2878,124 @@ def send_assistant_message(current_user):
         'timestamp': datetime.utcnow()
     }
     
-    messages_collection.insert_one(user_message)
+    try:
+        message_buffer.add(user_message)
+    except Exception:
+        generation_tracker.finish(session_id, message_id)
+        raise
     
-    # Here you would typically send the message to your AI assistant
-    # For now, we'll just echo back
-    assistant_message = {
-        'session_id': session_id,
-        'sender': 'assistant',
-        'content': f"I received your message: {message}",
-        'timestamp': datetime.utcnow()
-    }
+    # The reply is generated in the background and streamed via Socket.IO
+    socketio.start_background_task(run_generation, session_id, message_id, message, cancelled)
+    
+    return jsonify({'message': 'Message sent', 'message_id': message_id}), 202
+
+@app.route('/api/assistant/cancel', methods=['POST'])
+@token_required
+def cancel_assistant_message(current_user):
+    data = request.get_json()
+    session_id = data.get('session_id') if data else None
     
-    messages_collection.insert_one(assistant_message)
+    if not session_id:
+        return jsonify({'error': 'Missing session_id'}), 400
     
-    # Emit the message via Socket.IO
-    socketio.emit('assistant_message', assistant_message, room=session_id)
+    if not owns_session(current_user['_id'], session_id):
+        return jsonify({'error': 'Session not found'}), 404
     
-    return jsonify({'message': 'Message sent'})
+    cancelled = generation_tracker.cancel(session_id, data.get('message_id'))
+    return jsonify({'cancelled': cancelled})
 
 # Socket.IO Events
+# Assistant sessions each socket joined, to deactivate them when it disconnects
+socket_sessions = {}
+# User each socket authenticated as on connect
+socket_users = {}
+
+def token_user_id(token):
+    try:
+        return jwt.decode(token, app.config['SECRET_KEY'], algorithms=["HS256"])['user_id']
+    except Exception:
+        return None
+
 @socketio.on('connect')
-def handle_connect():
+def handle_connect(auth=None):
+    # Browsers drop extra headers on websocket transports, so the token comes in auth
+    token = (auth or {}).get('token')
+    if not token and 'Authorization' in request.headers:
+        token = request.headers['Authorization'].split(" ")[-1]
+    user_id = token_user_id(token) if token else None
+    if user_id:
+        socket_users[request.sid] = user_id
     print('Client connected')
 
+def socket_owns_session(session_id):
+    user_id = socket_users.get(request.sid)
+    return bool(session_id and user_id and owns_session(user_id, session_id))
+
 @socketio.on('disconnect')
 def handle_disconnect():
+    socket_users.pop(request.sid, None)
+    session_ids = list(socket_sessions.pop(request.sid, set()))
+    if session_ids:
+        # A session stays active while any socket (another tab, another node)
+        # is still joined; rejoining or resuming marks it active again
+        sessions_collection.update_many({'session_id': {'$in': session_ids}}, {'$pull': {'sockets': request.sid}})
+        sessions_collection.update_many(
+            {'session_id': {'$in': session_ids}, 'sockets': {'$size': 0}},
+            {'$set': {'active': False}}
+        )
     print('Client disconnected')
 
+@socketio.on('cancel_generation')
+def handle_cancel_generation(data):
+    session_id = data.get('session_id')
+    if socket_owns_session(session_id):
+        generation_tracker.cancel(session_id, data.get('message_id'))
+
 @socketio.on('join_session')
 def handle_join_session(data):
     session_id = data.get('session_id')
-    if session_id:
+    if socket_owns_session(session_id):
         join_room(session_id)
+        socket_sessions.setdefault(request.sid, set()).add(session_id)
+        sessions_collection.update_one(
+            {'session_id': session_id},
+            {
+                '$set': {'active': True, 'last_active_at': datetime.utcnow()},
+                '$addToSet': {'sockets': request.sid}
+            }
+        )
         print(f"User joined session {session_id}")
 
+# Startup
+def startup():
+    if os.environ.get('ENSURE_INDEXES', 'true') == 'true':
+        for failure in ensure_indexes()['failed']:
+            print(f"Could not create index {failure['index']}: {failure['error']}")
+    
+    resume_jobs()
+    socketio.start_background_task(resume_jobs_periodically, JOB_LEASE_SECONDS)
+    socketio.start_background_task(credit_pending_points_periodically, float(os.environ.get('PENDING_POINTS_INTERVAL', 60)))
+    load_leaderboards()
+    socketio.start_background_task(follow_leaderboards, float(os.environ.get('LEADERBOARD_REFRESH_INTERVAL', 300)))
+    
+    archive_interval = float(os.environ.get('MESSAGE_ARCHIVE_INTERVAL', 0))
+    if archive_interval:
+        socketio.start_background_task(archive_messages_periodically, archive_interval)
+
+def shutdown():
+    progress_buffer.flush()
+    message_buffer.flush()
+    kdf_pool.shutdown()
+    if media_pool is not None:
+        media_pool.shutdown(wait=False)
+
+atexit.register(shutdown)
+
 if __name__ == '__main__':
-    socketio.run(app, debug=True)
\ No newline at end of file
+    startup()
+    socketio.run(
+        app,
+        host=os.environ.get('HOST', '127.0.0.1'),
+        port=int(os.environ.get('PORT', 5000)),
+        debug=os.environ.get('DEBUG', 'true') == 'true'
+    )
\ No newline at end of file
@@ -12,7 +12,11 @@ export const SocketProvider = ({ children }) => {
   useEffect(() => {
     if (user) {
       const newSocket = io(WS_URL, {
+        transports: ['websocket'],
         withCredentials: true,
+        auth: {
+          token: localStorage.getItem('token')
+        },
         extraHeaders: {
           Authorization: `Bearer ${localStorage.getItem('token')}`
         }
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { Link, useNavigate } from 'react-router-dom';
-import api from '../../services/api';
+import api, { mediaUrl } from '../../services/api';
 import { FaPlus, FaEdit, FaTrash, FaUpload, FaSearch } from 'react-icons/fa';
 import { toast } from 'react-toastify';
 
@@ -184,7 +184,7 @@ const AdminCourses = () => {
                     <div className="flex items-center">
                       {course.thumbnail && (
                         <div className="flex-shrink-0 h-10 w-10">
-                          <img className="h-10 w-10 rounded-full object-cover" src={course.thumbnail} alt={course.title} />
+                          <img className="h-10 w-10 rounded-full object-cover" src={mediaUrl(course.thumbnail, 320)} alt={course.title} />
                         </div>
                       )}
                       <div className="ml-4">
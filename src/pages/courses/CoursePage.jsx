@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { useParams, useNavigate } from 'react-router-dom';
 import { useAuth } from '../../context/authcontext';
-import api from '../../services/api';
+import api, { mediaUrl } from '../../services/api';
 import { FaBook, FaChevronRight, FaLock, FaPlay, FaCheck, FaStar } from 'react-icons/fa';
 
 const CoursePage = () => {
@@ -113,7 +113,7 @@ const CoursePage = () => {
         <div className="md:w-1/3">
           <div className="bg-white rounded-lg shadow-md overflow-hidden sticky top-4">
             {course.thumbnail ? (
-              <img src={course.thumbnail} alt={course.title} className="w-full h-48 object-cover" />
+              <img src={mediaUrl(course.thumbnail, 640)} alt={course.title} className="w-full h-48 object-cover" />
             ) : (
               <div className="w-full h-48 bg-indigo-100 flex items-center justify-center text-indigo-600">
                 <FaBook className="text-4xl" />
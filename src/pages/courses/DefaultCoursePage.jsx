@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { Link } from 'react-router-dom';
-import api from '../../services/api';
+import api, { mediaUrl } from '../../services/api';
 import { FaSearch, FaBook, FaStar, FaClock, FaLock } from 'react-icons/fa';
 
 const DefaultCoursePage = () => {
@@ -111,7 +111,7 @@ const DefaultCoursePage = () => {
               <div key={course.id} className="bg-white rounded-xl shadow-md overflow-hidden hover:shadow-lg transition">
                 <div className="h-48 bg-gray-200 overflow-hidden">
                   {course.thumbnail ? (
-                    <img src={course.thumbnail} alt={course.title} className="w-full h-full object-cover" />
+                    <img src={mediaUrl(course.thumbnail, 640)} alt={course.title} className="w-full h-full object-cover" />
                   ) : (
                     <div className="w-full h-full flex items-center justify-center bg-indigo-100 text-indigo-600">
                       {getCategoryIcon(course.category)}
@@ -156,7 +156,7 @@ const DefaultCoursePage = () => {
               <div key={course.id} className="bg-white rounded-lg shadow-md overflow-hidden hover:shadow-lg transition">
                 <div className="h-40 bg-gray-200 overflow-hidden">
                   {course.thumbnail ? (
-                    <img src={course.thumbnail} alt={course.title} className="w-full h-full object-cover" />
+                    <img src={mediaUrl(course.thumbnail, 640)} alt={course.title} className="w-full h-full object-cover" />
                   ) : (
                     <div className="w-full h-full flex items-center justify-center bg-indigo-100 text-indigo-600">
                       {getCategoryIcon(course.category)}
@@ -1,6 +1,6 @@
 import React, { useState, useEffect } from 'react';
 import { Link } from 'react-router-dom';
-import api from '../../services/api';
+import api, { mediaUrl } from '../../services/api';
 import { useAuth } from '../../context/authcontext';
 import { FaBook, FaChartLine, FaTrophy, FaClock } from 'react-icons/fa';
 
@@ -112,7 +112,7 @@ const DashboardPage = () => {
                 <div key={course.id} className="bg-white rounded-lg shadow overflow-hidden">
                   <div className="h-40 bg-gray-200 overflow-hidden">
                     {course.thumbnail ? (
-                      <img src={course.thumbnail} alt={course.title} className="w-full h-full object-cover" />
+                      <img src={mediaUrl(course.thumbnail, 640)} alt={course.title} className="w-full h-full object-cover" />
                     ) : (
                       <div className="w-full h-full flex items-center justify-center bg-indigo-100 text-indigo-600">
                         <FaBook className="text-2xl" />
@@ -1,7 +1,7 @@
 import React, { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import { useAuth } from '../../context/authcontext';
-import api from '../../services/api';
+import api, { mediaUrl } from '../../services/api';
 import { FaSearch, FaLanguage, FaLaptopCode, FaCalculator, FaFlask, FaHistory } from 'react-icons/fa';
 
 const HomePage = () => {
@@ -127,7 +127,7 @@ const HomePage = () => {
               <div key={course.id} className="bg-white rounded-xl shadow-md overflow-hidden hover:shadow-lg transition">
                 <div className="h-48 bg-gray-200 overflow-hidden">
                   {course.thumbnail ? (
-                    <img src={course.thumbnail} alt={course.title} className="w-full h-full object-cover" />
+                    <img src={mediaUrl(course.thumbnail, 640)} alt={course.title} className="w-full h-full object-cover" />
                   ) : (
                     <div className="w-full h-full flex items-center justify-center bg-indigo-100 text-indigo-600">
                       {getCategoryIcon(course.category)}
@@ -172,7 +172,7 @@ const HomePage = () => {
               <div key={course.id} className="bg-white rounded-lg shadow-md overflow-hidden hover:shadow-lg transition">
                 <div className="h-40 bg-gray-200 overflow-hidden">
                   {course.thumbnail ? (
-                    <img src={course.thumbnail} alt={course.title} className="w-full h-full object-cover" />
+                    <img src={mediaUrl(course.thumbnail, 640)} alt={course.title} className="w-full h-full object-cover" />
                   ) : (
                     <div className="w-full h-full flex items-center justify-center bg-indigo-100 text-indigo-600">
                       {getCategoryIcon(course.category)}
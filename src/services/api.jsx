@@ -130,4 +130,17 @@ export const bookmarkAPI = {
   removeBookmark: (lessonId) => api.delete(`/bookmarks/${lessonId}`),
 };
 
+// Uploaded media is stored as a path on the API server (e.g. /media/<digest>.png);
+// width asks for the smallest WebP variant at least that wide
+export const mediaUrl = (path, width) => {
+  if (!path || !path.startsWith('/')) {
+    return path;
+  }
+  const url = new URL(path, api.defaults.baseURL);
+  if (width) {
+    url.searchParams.set('w', width);
+  }
+  return url.href;
+};
+
 export default api;
\ No newline at end of file